@@ -0,0 +1,718 @@
+from lib import *
+from scrape import HISTORY_PAGE_SIZE, cleanAllData, generateConversations, messageToRow, scrapeChannels
+import argparse
+import asyncio
+import bisect
+import contextlib
+import io
+import random
+import sys
+import tempfile
+import time
+import types
+
+# Benchmarks for the data pipeline and chat bot. None of these need a Discord connection, and the data pipeline ones
+# don't need the real config.json/names.json either, since they run on synthetic data that is generated from a fixed seed.
+# Usage: python bench.py <benchmark> [--count N] [--seed N]
+
+
+# ----- Synthetic data -----
+
+def randomSnowflake(rng : random.Random) -> int:
+    """Returns a random Discord-like snowflake ID (18 digits)"""
+    return rng.randrange(10**17, 10**18)
+
+
+def syntheticNamesAndConfig(rng : random.Random, nameCount = 50) -> tuple[dict[str, str], dict[str, (str | int | list[int])]]:
+    """Returns a names dict and a config dict shaped like the ones loaded from names.json and config.json"""
+    ids = [randomSnowflake(rng) for _ in range(nameCount + 4)]
+    firstNames = ["Tom", "Joe", "Jeremy", "Rhett", "Paul", "Sam", "Alex", "Kim", "Max", "Lee"]
+    names = {str(id): f"{firstNames[i % 10]} {chr(ord('A') + i // 10)}." for i, id in enumerate(ids[:nameCount])}
+    names[str(ids[nameCount + 2])] = "general"
+    names[str(ids[nameCount + 3])] = "memes"
+    config = {
+        "botToken": "",
+        "botID": ids[nameCount],
+        "userToImpersonateID": ids[0],
+        "guildID": ids[nameCount + 1],
+        "channelIDs": [ids[nameCount + 2], ids[nameCount + 3]],
+    }
+    return (names, config)
+
+
+SYNTHETIC_WORDS = ["lol", "what", "no way", "that's", "so", "true", "bruh", "okay", "did you see", "the", "game", "last night", "😂", "🔥"]
+
+
+def syntheticMentionMsgs(rng : random.Random, names : dict[str, str], config : dict[str, (str | int | list[int])], count : int) -> list[tuple[str, str]]:
+    """Returns a list of (msgContent, sentBy) pairs that are heavy on mentions, emoji and links.
+    Some messages span several lines, and some mention the same ID more than once (e.g. on different lines).
+    """
+    knownIDs = list(names.keys())[:-2]     # user IDs only
+    words = SYNTHETIC_WORDS
+    msgs = []
+    for _ in range(count):
+        parts = []
+        mentioned = []
+        for _ in range(rng.randint(3, 12)):
+            roll = rng.random()
+            if roll < 0.35:     # mention of a known or unknown user/role/channel, or of one that was already mentioned
+                if mentioned and rng.random() < 0.2:
+                    id = rng.choice(mentioned)
+                else:
+                    id = rng.choice(knownIDs) if rng.random() < 0.7 else str(randomSnowflake(rng))
+                mentioned.append(id)
+                parts.append(rng.choice(["<@", "<@!", "<@&", "<#"]) + id + ">")
+            elif roll < 0.42:   # discord emoji
+                parts.append(f"<{rng.choice(['', 'a'])}:emote{rng.randint(0, 99)}:{randomSnowflake(rng)}>")
+            elif roll < 0.47:   # link
+                parts.append(f"https://example.com/{rng.randint(0, 10**6)}")
+            elif roll < 0.49:   # mention of the bot itself
+                parts.append(f"<@{config['botID']}>")
+            else:
+                parts.append(rng.choice(words))
+        if rng.random() < 0.3:  # several lines, with mentions on any of them
+            content = "".join(part + rng.choice([" ", " ", "\n"]) for part in parts).strip(" \n")
+        else:
+            content = rng.choice([" ", "  ", "\n", " \t "]).join(parts)
+        if rng.random() < 0.05:
+            content = "/kc " + content
+        sentBy = str(config["botID"]) if rng.random() < 0.05 else rng.choice(knownIDs)
+        msgs.append((content, sentBy))
+    return msgs
+
+
+def syntheticChatMsg(rng : random.Random, knownIDs : list[str]) -> str:
+    """Returns the content of a typical chat message: mostly plain words, sometimes with a mention, emoji or link, and sometimes only a link"""
+    parts = [rng.choice(SYNTHETIC_WORDS) for _ in range(rng.randint(1, 12))]
+    roll = rng.random()
+    if roll < 0.10:     # mention of a known user
+        parts.insert(rng.randint(0, len(parts)), f"<@{rng.choice(knownIDs)}>")
+    elif roll < 0.15:   # discord emoji
+        parts.append(f"<:emote{rng.randint(0, 99)}:{randomSnowflake(rng)}>")
+    elif roll < 0.18:   # link
+        parts.append(f"https://example.com/{rng.randint(0, 10**6)}")
+    elif roll < 0.20:   # only a link, which is empty after cleaning
+        parts = [f"https://example.com/{rng.randint(0, 10**6)}"]
+    return " ".join(parts)
+
+
+def syntheticHistory(rng : random.Random, names : dict[str, str], config : dict[str, (str | int | list[int])], count : int) -> list[tuple]:
+    """Returns `count` Message rows spread over the channels in config, with realistic gaps between messages and reply chains.
+    Rows are not assigned to conversations yet (conversid = -1) or cleaned, like freshly scraped messages.
+    """
+    knownIDs = list(names.keys())[:-2]     # user IDs only
+    userIDs = [int(id) for id in knownIDs[:10]]
+    rows = []
+    for (channelIndex, channelID) in enumerate(config["channelIDs"]):
+        sentMs = 1577836800000 + channelIndex * 1000     # 2020-01-01
+        recentIDs = []
+        for _ in range(count // len(config["channelIDs"])):
+            roll = rng.random()
+            if roll < 0.02:     # a long silence, which should start a new conversation
+                sentMs += rng.randint(8 * 60 * 60 * 1000, 3 * 24 * 60 * 60 * 1000)
+            elif roll < 0.15:
+                sentMs += rng.randint(10 * 60 * 1000, 2 * 60 * 60 * 1000)
+            else:
+                sentMs += rng.randint(1000, 5 * 60 * 1000)
+            messageid = ((sentMs - DISCORD_EPOCH_MS) << 22) + rng.randrange(1 << 22)
+            replyid = rng.choice(recentIDs[-50:]) if recentIDs and rng.random() < 0.1 else None
+            sent = str(datetime.datetime.fromtimestamp(sentMs / 1000, tz=datetime.timezone.utc))
+            rows.append((messageid, channelID, names.get(str(channelID), "general"), rng.choice(userIDs), "user", sent, syntheticChatMsg(rng, knownIDs), replyid, -1, 1, sentMs))
+            recentIDs.append(messageid)
+    return rows
+
+
+def syntheticDB(rows : list[tuple], path : str) -> tuple[sqlite3.Connection, sqlite3.Cursor]:
+    """Returns a connection to a new database at `path` (with the latest schema) containing the given rows"""
+    con = sqlite3.connect(path)
+    cur = con.cursor()
+    for pragma in DB_PRAGMAS:
+        cur.execute(pragma)
+    migrateDB(con, cur)
+    cur.executemany("INSERT INTO Message (messageid, channelid, channelname, userid, username, sent, content, replyid, conversid, isFirstInConvers, sent_ms) " +
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", rows)
+    con.commit()
+    return (con, cur)
+
+
+class FakeMessage:
+    """Stand-in for a discord.Message made from a synthetic Message row, with only the attributes the scraper reads"""
+    def __init__(self, row : tuple, channel : "FakeChannel") -> None:
+        (self.id, _, _, authorID, authorName, self.created_at, self.content, replyID) = row[:8]
+        self.channel = channel
+        self.author = types.SimpleNamespace(id=authorID, name=authorName)
+        self.reference = types.SimpleNamespace(message_id=replyID) if replyID is not None else None
+
+
+class FakeChannel:
+    """Stand-in for a discord.TextChannel whose history is made of synthetic Message rows.
+    Like Discord, it sends its history in pages of HISTORY_PAGE_SIZE messages, each one taking `pageLatency` seconds to arrive.
+    """
+    def __init__(self, channelID : int, name : str, rows : list[tuple], pageLatency : float = 0.01) -> None:
+        self.id = channelID
+        self.name = name
+        self.pageLatency = pageLatency
+        self.requests = 0
+        # Messages are only made from the rows as they are sent, so even very long histories take little memory
+        self.rows = sorted((row for row in rows if row[1] == channelID), key=lambda row: row[0])
+        self.ids = [row[0] for row in self.rows]
+
+    def __str__(self) -> str:
+        return self.name
+
+    async def fetch_message(self, id : int) -> FakeMessage:
+        self.requests += 1
+        await asyncio.sleep(self.pageLatency)
+        return FakeMessage(self.rows[bisect.bisect_left(self.ids, id)], self)
+
+    async def history(self, limit : int = 100, after = None, oldest_first : bool = None):
+        rows = self.rows[bisect.bisect_right(self.ids, after.id):] if after is not None else self.rows
+        if not oldest_first:
+            rows = rows[::-1]
+        if limit is not None:
+            rows = rows[:limit]
+        for start in range(0, len(rows), HISTORY_PAGE_SIZE):
+            self.requests += 1
+            await asyncio.sleep(self.pageLatency)
+            for row in rows[start:start + HISTORY_PAGE_SIZE]:
+                yield FakeMessage(row, self)
+
+
+def writeSyntheticCorpus(path : str, count : int, seed : int):
+    """Writes a Message.db at `path` with `count` synthetic messages, as scrape.py would before cleaning & segmenting them.
+    The names & config they go with are syntheticNamesAndConfig(random.Random(seed)).
+    """
+    rng = random.Random(seed)
+    (names, config) = syntheticNamesAndConfig(rng)
+    (con, _) = syntheticDB(syntheticHistory(rng, names, config, count), path)
+    con.close()
+    print(f"Wrote {count} synthetic messages to {path}")
+
+
+# ----- Reference implementations (copies of old code, kept to measure speedups against) -----
+
+def legacyCleanMsg(msgContent : str, sentBy : str, names : dict[str, str], config : dict[str, (str | int | list[int])], isTrainingData = False) -> str:
+    """cleanMsg() as it was before MsgCleaner, which built & ran a new regex for every mention"""
+    if isTrainingData and (re.match(r"/kc", msgContent) != None or str(sentBy) == str(config["botID"])):
+        return ""
+    elif not isTrainingData:
+        msgContent = re.sub(str(config["botID"]), str(config["userToImpersonateID"]), msgContent)
+        if re.match(r"/kc ", msgContent) != None:
+            msgContent = msgContent[4:].strip()
+    msgContent = re.sub(r"http\S+|www\S+|https\S+", "", msgContent)
+    msgContent = re.sub(r"\<.+?:\d+\>", "", msgContent)
+    mentions = re.findall(r"\<[#@].*?(\d+?)\>", msgContent)
+    for id in mentions:
+        if id in names:
+            msgContent = re.sub(r"\<[#@].*?" + id + r"\>", names[id], msgContent)
+        else:
+            msgContent = re.sub(r"\<[#@].*?" + id + r"\>", "", msgContent)
+    msgContent = re.sub(r"(?:(?!\n)\s)+", " ", msgContent)
+    msgContent = msgContent.strip()
+    return msgContent
+
+
+def legacyGetDateTime(message : Message) -> datetime.datetime:
+    """getDateTime() as it was before the sent_ms column, which parsed the "sent" string"""
+    try:
+        return datetime.datetime.strptime(message.sent, "%Y-%m-%d %H:%M:%S.%f%z")
+    except ValueError:
+        return datetime.datetime.strptime(message.sent, "%Y-%m-%d %H:%M:%S%z")
+
+
+def legacyGenerateConversations(con : sqlite3.Connection, cur : sqlite3.Cursor, names : dict[str, str], config : dict[str, (str | int | list[int])]):
+    """generateConversations() as it was before ConversationSegmenter, which parsed dates twice per message,
+    looked up the parent of every reply in db, and updated messages one at a time
+    """
+    updCur = con.cursor()
+    cur.execute("SELECT conversid FROM Message ORDER BY conversid DESC;")
+    biggestConversID = cur.fetchone()[0]
+    for channelID in config["channelIDs"]:
+        cur.execute("SELECT * FROM Message WHERE channelid = ? ORDER BY sent ASC;", (channelID,))
+        prevMsg : Message = None
+        prevMsgFromOtherUser : Message = None
+        prevMsgConversID : int = None
+        for row in cur:
+            msg = Message(row)
+            if msg.conversid != -1:
+                prevMsg = msg
+                prevMsgFromOtherUser = msg
+                continue
+            elif prevMsg == None:
+                biggestConversID += 1
+                updCur.execute("UPDATE Message SET conversid = ?, isFirstInConvers = 1 WHERE messageid = ?;", (biggestConversID, msg.messageid))
+                prevMsg = msg
+                prevMsgFromOtherUser = msg
+                prevMsgConversID = biggestConversID
+            else:
+                if msg.userid != prevMsg.userid:
+                    prevMsgFromOtherUser = prevMsg
+                if (msg.replyid == None) & (legacyGetDateTime(prevMsgFromOtherUser) < (legacyGetDateTime(msg) - datetime.timedelta(hours=8))):
+                    biggestConversID += 1
+                    updCur.execute("UPDATE Message SET conversid = ?, isFirstInConvers = 1 WHERE messageid = ?;", (biggestConversID, msg.messageid))
+                    prevMsg = msg
+                    prevMsgConversID = biggestConversID
+                    prevMsgFromOtherUser = msg
+                elif (msg.replyid != None):
+                    updCur.execute("SELECT conversid FROM Message WHERE messageid = ?;", (msg.replyid,))
+                    conversID = updCur.fetchone()[0]
+                    updCur.execute("UPDATE Message SET conversid = ?, isFirstInConvers = 0 WHERE messageid = ?;", (conversID, msg.messageid))
+                    prevMsg = msg
+                    prevMsgConversID = conversID
+                else:
+                    updCur.execute("UPDATE Message SET conversid = ?, isFirstInConvers = 0 WHERE messageid = ?;", (prevMsgConversID, msg.messageid))
+                    prevMsg = msg
+    con.commit()
+    updCur.close()
+
+
+async def legacyScrape(con : sqlite3.Connection, cur : sqlite3.Cursor, channels : list[FakeChannel], limit : int = 10000):
+    """The scraping loop of ScrapeClient.on_ready() as it was before scrapeChannels(), which scraped one channel at a time
+    and saved each channel's messages in one go once it was done. It used to scrape at most 10000 messages per channel.
+    """
+    for chan in channels:
+        mostRecentMsg = getMostRecent(con, cur, chan.id)
+        if mostRecentMsg != None:
+            mostRecentMsg = await chan.fetch_message(mostRecentMsg)
+        msgBatch = []
+        async for message in chan.history(limit=limit, after=mostRecentMsg, oldest_first=True):
+            msgBatch.append(messageToRow(message))
+        cur.executemany("INSERT OR IGNORE INTO Message (messageid, channelid, channelname, userid, username, sent, content, replyid, conversid, isFirstInConvers, sent_ms) " +
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", msgBatch)
+        con.commit()
+
+
+# ----- Benchmarks -----
+
+def timed(func, *args) -> tuple[float, any]:
+    """Runs func(*args) and returns (seconds taken, return value)"""
+    start = time.perf_counter()
+    result = func(*args)
+    return (time.perf_counter() - start, result)
+
+
+def benchClean(count : int, seed : int):
+    """Compares MsgCleaner against the old cleanMsg on a mention-heavy corpus, and checks that their output is identical"""
+    rng = random.Random(seed)
+    (names, config) = syntheticNamesAndConfig(rng)
+    msgs = syntheticMentionMsgs(rng, names, config, count)
+
+    for isTrainingData in (True, False):
+        legacyTime, legacyOut = timed(lambda: [legacyCleanMsg(content, sentBy, names, config, isTrainingData) for (content, sentBy) in msgs])
+        cleaner = MsgCleaner(names, config)
+        newTime, newOut = timed(cleaner.clean_many, msgs, isTrainingData)
+        mismatches = sum(1 for (a, b) in zip(legacyOut, newOut) if a != b)
+        print(f"cleanMsg (isTrainingData={isTrainingData}) on {count} messages:")
+        print(f"\told:  {count / legacyTime:,.0f} msgs/sec")
+        print(f"\tnew:  {count / newTime:,.0f} msgs/sec ({legacyTime / newTime:.1f}x)")
+        print(f"\t{mismatches} outputs differ")
+
+
+def benchConversations(count : int, seed : int):
+    """Compares generateConversations() against the old implementation on two copies of the same database,
+    and checks that they assign every message to the same conversation
+    """
+    rng = random.Random(seed)
+    (names, config) = syntheticNamesAndConfig(rng)
+    rows = syntheticHistory(rng, names, config, count)
+    with tempfile.TemporaryDirectory() as tmpDir:
+        (legacyCon, legacyCur) = syntheticDB(rows, os.path.join(tmpDir, "legacy.db"))
+        (newCon, newCur) = syntheticDB(rows, os.path.join(tmpDir, "new.db"))
+
+        legacyTime, _ = timed(legacyGenerateConversations, legacyCon, legacyCur, names, config)
+        newTime, _ = timed(generateConversations, newCon, newCur, names, config)
+        query = "SELECT messageid, conversid, isFirstInConvers FROM Message ORDER BY messageid;"
+        mismatches = sum(1 for (a, b) in zip(legacyCur.execute(query).fetchall(), newCur.execute(query).fetchall()) if a != b)
+        legacyCon.close()
+        newCon.close()
+    print(f"generateConversations on {len(rows)} messages:")
+    print(f"\told:  {len(rows) / legacyTime:,.0f} msgs/sec ({legacyTime:.2f}s)")
+    print(f"\tnew:  {len(rows) / newTime:,.0f} msgs/sec ({newTime:.2f}s, {legacyTime / newTime:.1f}x)")
+    print(f"\t{mismatches} assignments differ")
+
+
+def benchScrape(count : int, seed : int):
+    """Compares scraping 4 fake channels one at a time (the old ScrapeClient.on_ready()) against scrapeChannels(),
+    and checks that both save the same messages. Each page of history takes 10ms to arrive, and the request budget is turned off.
+    The old loop's 10000 message limit per channel is lifted, so both scrape everything.
+    """
+    import tracemalloc
+
+    rng = random.Random(seed)
+    (names, config) = syntheticNamesAndConfig(rng)
+    config["channelIDs"] += [randomSnowflake(rng) for _ in range(2)]
+    rows = syntheticHistory(rng, names, config, count)
+    print(f"Scraping {len(rows)} messages from {len(config['channelIDs'])} channels:")
+    savedMessages = []
+    for (label, scrape) in (("old", lambda con, cur, channels: legacyScrape(con, cur, channels, limit=None)), ("new", lambda con, cur, channels: scrapeChannels(con, cur, channels, requestsPerSecond=0))):
+        channels = [FakeChannel(channelID, f"channel{i}", rows) for (i, channelID) in enumerate(config["channelIDs"])]
+        with tempfile.TemporaryDirectory() as tmpDir:
+            (con, cur) = syntheticDB([], os.path.join(tmpDir, "Message.db"))
+            with contextlib.redirect_stdout(io.StringIO()):     # scrapeChannels() prints its progress
+                tracemalloc.start()
+                seconds, _ = timed(asyncio.run, scrape(con, cur, channels))
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            savedMessages.append(cur.execute("SELECT messageid, channelid, userid, content, replyid, sent_ms FROM Message ORDER BY messageid;").fetchall())
+            con.close()
+        print(f"\t{label}:  {len(savedMessages[-1]) / seconds:,.0f} msgs/sec ({seconds:.2f}s), peak Python memory {peak / 2**20:.1f} MiB")
+    print(f"\t{'same' if savedMessages[0] == savedMessages[1] else 'DIFFERENT'} messages saved ({len(savedMessages[1])})")
+
+
+def benchFolds(count : int, seed : int):
+    """Compares building the 10 cross-validation folds with buildFolds() against the old percent-slice load_dataset() calls,
+    on the same synthetic training data file. Needs the training packages (datasets, trl, transformers) installed.
+    """
+    import datasets
+    import tracemalloc
+    from train import buildFolds
+
+    rng = random.Random(seed)
+    (names, config) = syntheticNamesAndConfig(rng)
+    rows = syntheticHistory(rng, names, config, count)
+    with tempfile.TemporaryDirectory() as tmpDir:
+        (con, cur) = syntheticDB(rows, os.path.join(tmpDir, "Message.db"))
+        generateConversations(con, cur, names, config)
+        examplesLoc = os.path.join(tmpDir, "examples.jsonl")
+        exampleCount = writeTrainingData(iterTrainingData(con, cur, names=names, config=config), examplesLoc)
+        con.close()
+
+        def oldFolds():
+            dataset = datasets.load_dataset("json", data_files = examplesLoc, cache_dir = os.path.join(tmpDir, "old"))
+            split_dataset = dataset['train'].train_test_split(test_size=0.2)
+            val_ds = datasets.load_dataset("json", data_files = examplesLoc, split=[f"train[{k}%:{k+10}%]" for k in range(0, 100, 10)], cache_dir = os.path.join(tmpDir, "old"))
+            train_ds = datasets.load_dataset("json", data_files = examplesLoc, split=[f"train[:{k}%]+train[{k+10}%:]" for k in range(0, 100, 10)], cache_dir = os.path.join(tmpDir, "old"))
+            return (train_ds, val_ds)
+
+        def newFolds():
+            dataset = datasets.load_dataset("json", data_files = examplesLoc, split = "train", cache_dir = os.path.join(tmpDir, "new"))
+            return buildFolds(dataset)
+
+        print(f"Building 10 folds from {exampleCount} examples:")
+        for (label, build) in (("old", oldFolds), ("new", newFolds)):
+            tracemalloc.start()
+            seconds, _ = timed(build)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"\t{label}:  {seconds:.2f}s, peak Python memory {peak / 2**20:.1f} MiB")
+
+
+def benchPersonas(count : int, seed : int):
+    """Compares writing the training data of 4 personas with one iterPersonaTrainingData() pass against one iterTrainingData() pass
+    per persona (as train.py would have to, one persona at a time), and checks that every persona gets the same examples.
+    Needs transformers (for token counts).
+    """
+    rng = random.Random(seed)
+    (names, config) = syntheticNamesAndConfig(rng)
+    rows = syntheticHistory(rng, names, config, count)
+    userIDs = [int(userID) for userID in list(names.keys())[:4]]
+    with tempfile.TemporaryDirectory() as tmpDir:
+        (con, cur) = syntheticDB(rows, os.path.join(tmpDir, "Message.db"))
+        generateConversations(con, cur, names, config)
+        updateTokenCounts(con, cur)     # so neither side pays for counting tokens
+        oldPaths = {userID: os.path.join(tmpDir, f"old-{userID}.jsonl") for userID in userIDs}
+        newPaths = {userID: os.path.join(tmpDir, f"new-{userID}.jsonl") for userID in userIDs}
+        with contextlib.redirect_stdout(io.StringIO()):
+            oldSeconds, _ = timed(lambda: [writeTrainingData(iterTrainingData(con, cur, names=names, config=personaConfig(config, userID)), oldPaths[userID])
+                                           for userID in userIDs])
+            newSeconds, counts = timed(writePersonaTrainingData, iterPersonaTrainingData(con, cur, userIDs, names=names, config=config), newPaths)
+        con.close()
+        same = all(open(oldPaths[userID], "rb").read() == open(newPaths[userID], "rb").read() for userID in userIDs)
+    print(f"Training data for {len(userIDs)} personas ({sum(counts.values()):,} examples) from {len(rows):,} messages:")
+    print(f"\tone pass per persona:  {oldSeconds:.2f}s")
+    print(f"\tone pass for all:  {newSeconds:.2f}s ({oldSeconds / newSeconds:.1f}x faster)")
+    print(f"\tSame examples: {same}")
+
+
+def syntheticExamples(rng : random.Random, names : dict[str, str], count : int) -> list[tuple[dict[str, str], str]]:
+    """Returns `count` (example, kind) pairs shaped like the examples iterTrainingData() yields, where kind says which junk was mixed in:
+    "clean", "short reply" (a common reply like "lol", which should be kept), "duplicate" (a copy of an earlier example),
+    "repeated output" (one of a few spam responses) or "echo" (repeats the last message).
+    Messages use a vocabulary of 5000 made-up words, since SYNTHETIC_WORDS alone would make most messages look like near-duplicates.
+    """
+    nicknames = list(names.values())
+    vocab = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 8))) for _ in range(5000)] + SYNTHETIC_WORDS
+    def chatMsg() -> str:
+        return " ".join(rng.choice(vocab) for _ in range(rng.randint(1, 12)))
+    shortReplies = ["lol", "lmao", "true", "yeah"]
+    spam = ["badger badger badger badger badger badger", "MUSHROOM MUSHROOM it's a snake oh it's a snake",
+            "never gonna give you up never gonna let you down"]
+    examples = []
+    history = []
+    while len(examples) < count:
+        history = (history + [f"{rng.choice(nicknames)}: {chatMsg()}" for _ in range(rng.randint(1, 3))])[-10:]
+        roll = rng.random()
+        if roll < 0.10 and examples:
+            examples.append((dict(rng.choice(examples)[0]), "duplicate"))
+            continue
+        if roll < 0.15:
+            (output, kind) = (rng.choice(spam), "repeated output")
+        elif roll < 0.18:
+            # the last message again (padded so it is long enough to count as an echo), with different capitalization
+            history[-1] = f"{history[-1]} {chatMsg()} {chatMsg()}"
+            (output, kind) = (history[-1].split(": ", 1)[1].upper(), "echo")
+        elif roll < 0.48:
+            (output, kind) = (rng.choice(shortReplies), "short reply")
+        else:
+            (output, kind) = (chatMsg(), "clean")
+        examples.append(({"input": "\n".join(history[-rng.randint(3, 10):]), "output": output}, kind))
+    return examples
+
+
+def benchDedup(count : int, seed : int):
+    """Measures how fast ExampleDeduplicator filters synthetic training examples, and how much of the injected junk it drops
+    (and how many clean examples it drops by mistake). Needs numpy.
+    """
+    rng = random.Random(seed)
+    (names, config) = syntheticNamesAndConfig(rng)
+    examples = syntheticExamples(rng, names, count)
+    dedup = ExampleDeduplicator()
+    kinds = {}
+    def run():
+        for (example, kind) in examples:
+            dedup.total += 1
+            reason = dedup.check(example)
+            kinds.setdefault(kind, {"total": 0, "dropped": 0})["total"] += 1
+            kinds[kind]["dropped"] += reason is not None
+    seconds, _ = timed(run)
+    print(f"Filtered {len(examples):,} examples in {seconds:.2f}s ({len(examples) / seconds:,.0f} examples/sec):")
+    for (kind, counts) in kinds.items():
+        print(f"\t{kind}:  dropped {counts['dropped']:,} of {counts['total']:,} ({counts['dropped'] / counts['total']:.1%})")
+
+
+def benchBatching(count : int, seed : int):
+    """Measures total generated tokens/sec and p95 latency of concurrent chat requests (at most 32), generated one at a time vs. in micro-batches.
+    Needs a trained model (see chat.py).
+    """
+    import asyncio
+    import chat
+
+    rng = random.Random(seed)
+    inputTexts = [rng.choice([chat.testmsg1, chat.testmsg2]) for _ in range(min(count, 32))]
+    print(f"{len(inputTexts)} concurrent chat requests over 3 channels:")
+    for maxBatchSize in (1, 4):
+        async def run() -> tuple[float, list[float], list[list[str]]]:
+            queue = chat.GenerationQueue(maxBatchSize=maxBatchSize)
+            latencies = []
+            async def request(channelID : int, inputText : str) -> list[str]:
+                start = time.perf_counter()
+                responses = await queue.submit(channelID, inputText)
+                latencies.append(time.perf_counter() - start)
+                return responses
+            start = time.perf_counter()
+            results = await asyncio.gather(*[request(i % 3, inputText) for (i, inputText) in enumerate(inputTexts)])
+            return (time.perf_counter() - start, latencies, results)
+        (seconds, latencies, results) = asyncio.run(run())
+        tokens = sum(len(chat.tokenizer.encode(response, add_special_tokens=False)) for responses in results for response in responses)
+        p95 = sorted(latencies)[int(0.95 * (len(latencies) - 1))]
+        print(f"\tmaxBatchSize={maxBatchSize}:  {tokens / seconds:,.1f} tokens/sec, p95 latency {p95:.1f}s")
+
+
+def benchPrefixCache(count : int, seed : int):
+    """Measures time-to-first-token of a chat request with and without the cached prompt prefix (median of up to 10 runs each).
+    Needs a trained model (see chat.py).
+    """
+    import chat
+
+    rng = random.Random(seed)
+    runs = min(count, 10)
+    chat.init_model()       # make sure the first timed run doesn't pay for loading anything
+    print(f"Time to first token (median of {runs} runs):")
+    for usePrefixCache in (False, True):
+        times = []
+        for _ in range(runs):
+            inputText = rng.choice([chat.testmsg1, chat.testmsg2])
+            seconds, _ = timed(lambda: chat.generate_messages([inputText], usePrefixCache = usePrefixCache, max_new_tokens = 1, num_return_sequences = 1))
+            times.append(seconds)
+        print(f"\t{'with' if usePrefixCache else 'without'} prefix cache:  {sorted(times)[len(times) // 2] * 1000:.0f}ms")
+
+
+def currentMemory() -> int:
+    """Returns the resident memory of this process in bytes (the peak so far, where the current value isn't available)"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024     # bytes on macOS, KiB elsewhere
+
+def benchBackends(count : int, seed : int):
+    """Compares chat.py's inference backends on load time, memory, latency of a chat request (median of up to 10 runs),
+    and perplexity of the responses in a held-out slice of the training data (the last 10% of the examples train.py wrote, at most `count`).
+    Needs a trained model (see chat.py) and its training data file. Backends whose packages aren't installed are skipped.
+    """
+    import chat
+    import math
+    import torch
+
+    datasetLoc = "db/input_output_dataset.jsonl"
+    if not os.path.exists(datasetLoc):
+        print(f"No training data at {datasetLoc}, run train.py first")
+        return
+    with open(datasetLoc, encoding = "utf-8") as dataFile:
+        examples = [json.loads(line) for line in dataFile]
+    heldOut = examples[len(examples) * 9 // 10:][:count]
+    chat.load_tokenizer()
+
+    def perplexity() -> float:
+        """Perplexity of the held-out responses, given their prompts (same prompt format as train.py)"""
+        totalLoss = 0.0
+        totalTokens = 0
+        for example in heldOut:
+            prompt = f"### Instruction:\n{example['instruction']}\n\n### Input:\n{example['input']}\n\n### Response:\n"
+            promptIDs = chat.tokenizer(prompt)["input_ids"]
+            responseIDs = chat.tokenizer(example["output"], add_special_tokens = False)["input_ids"]
+            inputIDs = torch.tensor([(promptIDs + responseIDs)[-1024:]])     # same limit as max_seq_length in train.py
+            responseLength = min(len(responseIDs), inputIDs.shape[1] - 1)
+            if responseLength <= 0:
+                continue
+            with torch.no_grad():
+                logits = chat.get_model().model(input_ids = inputIDs, attention_mask = torch.ones_like(inputIDs)).logits
+            # Loss of predicting each response token from the tokens before it
+            logProbs = torch.log_softmax(logits[0, -responseLength - 1:-1].float(), dim = -1)
+            totalLoss -= logProbs.gather(1, inputIDs[0, -responseLength:].unsqueeze(1)).sum().item()
+            totalTokens += responseLength
+        return math.exp(totalLoss / max(totalTokens, 1))
+
+    rng = random.Random(seed)
+    inputTexts = [rng.choice([chat.testmsg1, chat.testmsg2]) for _ in range(min(count, 10))]
+    print(f"Inference backends ({len(inputTexts)} timed requests, perplexity over {len(heldOut)} held-out examples):")
+    basePerplexity = None
+    for backend in chat.INFERENCE_BACKENDS:
+        if chat.model_cache is not None:
+            chat.model_cache.clear()    # let the previous backend's model be freed before measuring this one
+        startMemory = currentMemory()
+        try:
+            loadSeconds, _ = timed(chat.set_backend, backend)
+        except ImportError as e:
+            print(f"\t{backend}:  skipped ({e})")
+            continue
+        modelMemory = currentMemory() - startMemory
+        chat.generate_messages([inputTexts[0]], max_new_tokens = 1, num_return_sequences = 1)     # warm up
+        times = [timed(chat.generate_messages, [inputText])[0] for inputText in inputTexts]
+        ppl = perplexity()
+        if basePerplexity is None:
+            basePerplexity = ppl
+        print(f"\t{backend}:  loaded in {loadSeconds:.1f}s, +{modelMemory / 2**20:,.0f} MiB, "
+              f"median latency {sorted(times)[len(times) // 2]:.2f}s, perplexity {ppl:.3f} ({ppl - basePerplexity:+.3f} vs. {chat.INFERENCE_BACKENDS[0]})")
+
+
+def benchStartup(count : int, seed : int):
+    """Measures chat.py's startup in fresh processes (median of up to 5 runs each), as it was with the model loaded when chat.py is imported
+    vs. as it is now with the model loaded & warmed up in the background once the bot has connected:
+    time until the bot can connect to Discord, time until the model is ready, and the latency of the first reply after that.
+    Needs a trained model (see chat.py) and a filled in config.json.
+    """
+    import subprocess
+
+    script = """
+import json, time
+start = time.perf_counter()
+import chat
+imported = time.perf_counter()
+chat.init_model(warmUp = {warmUp})
+ready = time.perf_counter()
+import torch
+torch.manual_seed({seed})
+chat.generate_message(chat.testmsg1)
+print(json.dumps(dict(imported = imported - start, ready = ready - start, firstReply = time.perf_counter() - ready)))
+"""
+    runs = min(count, 5)
+    print(f"chat.py startup (median of {runs} runs):")
+    for (label, warmUp) in (("model loaded on import", False), ("model loaded after connecting", True)):
+        results = []
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, "-c", script.format(warmUp = warmUp, seed = seed)], capture_output = True, text = True,
+                                    check = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        median = lambda key: sorted(result[key] for result in results)[len(results) // 2]
+        # Before, the model was loaded when chat.py was imported, so the bot could only connect once it was ready
+        connect = median("imported") if warmUp else median("ready")
+        print(f"\t{label}:  connects after {connect:.1f}s, model ready after {median('ready'):.1f}s, first reply takes {median('firstReply'):.1f}s")
+
+
+def benchSuite(sizes : list[int], seed : int, jsonPath : str = None) -> dict:
+    """Times every stage of the data pipeline on synthetic corpora of each size, from scraping fake channels to formatting prompts.
+    Prints the results as JSON (and writes them to `jsonPath` if given), so they can be compared between versions. Progress goes to stderr.
+    The generateTrainingData stage needs transformers (for token counts), and the formatting_prompts_func stage needs the training packages
+    (datasets, trl, transformers). They are skipped without them. generateTrainingData includes counting the tokens of every message.
+    """
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            from train import formatting_prompts_func
+    except ImportError as e:
+        formatting_prompts_func = None
+        print(f"Skipping formatting_prompts_func ({e})", file=sys.stderr)
+
+    results = []
+    def record(size : int, stage : str, seconds : float, items : int):
+        results.append({"size": size, "stage": stage, "items": items, "seconds": round(seconds, 4), "itemsPerSec": round(items / seconds, 1) if seconds > 0 else None})
+        print(f"{size:>9} rows  {stage:<24} {items:>9} items  {seconds:8.2f}s", file=sys.stderr)
+
+    for size in sizes:
+        rng = random.Random(seed)
+        (names, config) = syntheticNamesAndConfig(rng)
+        seconds, rows = timed(syntheticHistory, rng, names, config, size)
+        record(size, "generate", seconds, len(rows))
+        with tempfile.TemporaryDirectory() as tmpDir, contextlib.redirect_stdout(sys.stderr):
+            (con, cur) = syntheticDB([], os.path.join(tmpDir, "Message.db"))
+            # Channels send their pages with no delay, so this measures the scraper's own overhead
+            channels = [FakeChannel(channelID, names[str(channelID)], rows, pageLatency=0) for channelID in config["channelIDs"]]
+            seconds, saved = timed(asyncio.run, scrapeChannels(con, cur, channels, requestsPerSecond=0))
+            record(size, "scrapeChannels", seconds, saved)
+            seconds, _ = timed(lambda: [cleanMsg(row[6], str(row[3]), names, config, True) for row in rows])
+            record(size, "cleanMsg", seconds, len(rows))
+            seconds, _ = timed(cleanAllData, con, cur, names, config)
+            record(size, "cleanAllData", seconds, len(rows))
+            seconds, _ = timed(generateConversations, con, cur, names, config)
+            record(size, "generateConversations", seconds, len(rows))
+            try:
+                seconds, examples = timed(generateTrainingData, con, cur, names, config)
+                record(size, "generateTrainingData", seconds, len(examples))
+            except ImportError as e:    # counting tokens for the chat history needs transformers
+                examples = None
+                print(f"Skipping generateTrainingData ({e})", file=sys.stderr)
+            con.close()
+        if formatting_prompts_func is not None and examples is not None:
+            batch = {key: [example[key] for example in examples] for key in ("instruction", "input", "output")}
+            seconds, _ = timed(formatting_prompts_func, batch)
+            record(size, "formatting_prompts_func", seconds, len(examples))
+
+    report = {"seed": seed, "python": sys.version.split()[0], "results": results}
+    print(json.dumps(report, indent=2))
+    if jsonPath is not None:
+        with open(jsonPath, "w", encoding="utf-8") as jsonFile:
+            json.dump(report, jsonFile, indent=2)
+    return report
+
+
+BENCHMARKS = {
+    "clean": benchClean,
+    "conversations": benchConversations,
+    "scrape": benchScrape,
+    "folds": benchFolds,
+    "personas": benchPersonas,
+    "dedup": benchDedup,
+    "batching": benchBatching,
+    "prefix": benchPrefixCache,
+    "backends": benchBackends,
+    "startup": benchStartup,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for KCBot's data pipeline. "
+                                     "'suite' times the whole pipeline at several sizes, and 'corpus' only writes a synthetic Message.db.")
+    parser.add_argument("benchmark", choices=list(BENCHMARKS.keys()) + ["suite", "corpus"])
+    parser.add_argument("--count", type=int, default=100000, help="number of synthetic messages to use")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the synthetic data generator")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="corpus sizes for 'suite'")
+    parser.add_argument("--json", default=None, help="file to also write the results of 'suite' to")
+    parser.add_argument("--out", default="Message.db", help="where 'corpus' writes the database")
+    args = parser.parse_args()
+    if args.benchmark == "suite":
+        benchSuite(args.sizes, args.seed, args.json)
+    elif args.benchmark == "corpus":
+        writeSyntheticCorpus(args.out, args.count, args.seed)
+    else:
+        BENCHMARKS[args.benchmark](args.count, args.seed)
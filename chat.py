@@ -1,53 +1,401 @@
+import time
+startTime = time.perf_counter()     # for measuring how long startup takes
 from lib import *
-import transformers
+from scrape import MessageIngester
+import asyncio
+from collections import OrderedDict
+import concurrent.futures
+import functools
+import threading
+from typing import TYPE_CHECKING
+# torch & transformers take seconds to import, so they are only imported where they are used (once the bot is connected)
+if TYPE_CHECKING:
+    import torch
+
+class GenerationQueue:
+    """Runs generate_messages() on worker threads behind a bounded queue, so generating a response never blocks the Discord event loop.
+    Requests are queued per channel and the channels take turns, so one busy channel can't starve the others.
+    Requests that arrive close together (and are for the same persona) are generated together in one batch, which gets more tokens/sec out of the CPU.
+    Create it from a running event loop (e.g. in setup_hook).
+
+    Args:
+        `maxConcurrent` = `1` : Number of batches that can be generated at the same time
+        `maxQueued` = `20` : Number of requests that can wait in the queue. Once it is full, new requests wait for space instead of being dropped.
+        `timeout` = `300` : Seconds a single batch may take to generate before its requests fail with asyncio.TimeoutError.
+         (The worker thread still finishes that batch in the background; its results are thrown away.)
+        `maxBatchSize` = `4` : Most requests to generate in one batch. 1 turns batching off.
+        `batchWindow` = `0.05` : Seconds to wait for more requests to batch with after one arrives. This is added to every response's latency.
+        `ready` = `True` : Whether to start generating right away. If False, requests wait in the queue until setup() is done.
+        `profiler` = `None` : If given, each batch is run under it when it is armed (see RequestProfiler)
+    """
+    def __init__(self, maxConcurrent = 1, maxQueued = 20, timeout : float = 300, maxBatchSize = 4, batchWindow : float = 0.05, ready = True,
+                 profiler : RequestProfiler = None) -> None:
+        self.timeout = timeout
+        self.profiler = profiler
+        self.maxBatchSize = maxBatchSize
+        self.batchWindow = batchWindow
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxConcurrent, thread_name_prefix="generate")
+        self.channelQueues : dict[int, deque[tuple[str, asyncio.Future, dict, float]]] = {}   # (inputText, future, kwargs, time it was queued)
+        self.channelTurns : deque[int] = deque()    # channels with queued requests, in the order they get their next turn
+        self.space = asyncio.Semaphore(maxQueued)   # free spaces in the queue
+        self.queued = asyncio.Semaphore(0)          # requests waiting in the queue
+        self.ready = asyncio.Event()
+        if ready:
+            self.ready.set()
+        self.workers = [asyncio.create_task(self.work()) for _ in range(maxConcurrent)]
+
+    async def submit(self, channelID : int, inputText : str, **kwargs) -> list[str]:
+        """Queues a request to generate responses to `inputText`, and returns the responses once they are generated.
+
+        Args:
+            `channelID` : ID of the channel the request came from
+            `inputText` : Chat history to respond to (see generate_message())
+            `**kwargs` : Arguments for generate_messages(), e.g. a persona, or overrides for generation_kwargs (e.g. a streamer).
+             Requests are only batched with requests that have the same arguments, so streamed requests are always generated on their own.
+        """
+        await self.space.acquire()
+        future = asyncio.get_running_loop().create_future()
+        self.channelQueues.setdefault(channelID, deque()).append((inputText, future, kwargs, time.perf_counter()))
+        if channelID not in self.channelTurns:
+            self.channelTurns.append(channelID)
+        self.queued.release()
+        return await future
+
+    def peek(self) -> tuple[str, asyncio.Future, dict, float]:
+        """Returns the request next() would take, without taking it"""
+        return self.channelQueues[self.channelTurns[0]][0]
+
+    def next(self) -> tuple[str, asyncio.Future, dict, float]:
+        """Takes the next request from the channel whose turn it is"""
+        channelID = self.channelTurns.popleft()
+        channelQueue = self.channelQueues[channelID]
+        request = channelQueue.popleft()
+        if channelQueue:    # this channel has more requests, so it goes to the back of the line
+            self.channelTurns.append(channelID)
+        else:
+            del self.channelQueues[channelID]
+        self.space.release()
+        metrics.observe("chat_queue_wait_seconds", time.perf_counter() - request[3])
+        return request
+
+    async def setup(self, func):
+        """Runs `func` (e.g. init_model) on a worker thread, then starts generating the requests that are waiting.
+        If it fails, the error is printed and generation starts anyway, so waiting requests fail instead of waiting forever.
+        """
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, func)
+        except Exception as e:
+            print(f"ERROR - Setting up generation failed: {e!r}")
+        self.ready.set()
+
+    async def work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.queued.acquire()
+            await self.ready.wait()
+            batch = [self.next()]
+            kwargs = batch[0][2]
+            # Streamed requests are generated on their own (each has its own streamer).
+            # Otherwise, give other requests a moment to arrive, then take as many as fit in this batch, as long as they have the same arguments (e.g. persona).
+            if "streamer" not in kwargs:
+                if self.maxBatchSize > 1 and self.batchWindow > 0:
+                    await asyncio.sleep(self.batchWindow)
+                while len(batch) < self.maxBatchSize and not self.queued.locked() and self.peek()[2] == kwargs:
+                    await self.queued.acquire()     # returns right away, since a request is waiting
+                    batch.append(self.next())
+            
+            batch = [(inputText, future) for (inputText, future, _, _) in batch if not future.cancelled()]   # skip requests nobody is waiting for
+            if not batch:
+                continue
+            metrics.observe("chat_batch_size", len(batch), COUNT_BUCKETS)
+            try:
+                inputTexts = [inputText for (inputText, _) in batch]
+                generate = functools.partial(generate_messages, inputTexts, **kwargs)
+                if self.profiler is not None and self.profiler.take():
+                    generate = functools.partial(self.profiler.run, "generate", generate)
+                results = await asyncio.wait_for(loop.run_in_executor(self.executor, generate), self.timeout)
+                for ((_, future), responses) in zip(batch, results):
+                    if not future.cancelled():
+                        future.set_result(responses)
+            except Exception as e:
+                for (_, future) in batch:
+                    if not future.cancelled():
+                        future.set_exception(e)
+
 
 class ChatClient(dc.Client):
     """Discord bot client for sending and responding to chat messages.
     When activated with initBot() it will respond to messages starting with "/kc"
-    in the the channels specified in config.json.
+    in the the channels specified in config.json. "/kc <persona>" responds as one of the "personas" in config.json instead of userToImpersonateID.
     """
-    config = getConfig()
-    names = getNames()
-    guildID = config["guildID"]
-    channelIDs = config["channelIDs"]
-    is_generating = False
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config = getConfig()
+        self.names = getNames()
+        self.guildID = self.config["guildID"]
+        self.channelIDs = self.config["channelIDs"]
+        self.queue : GenerationQueue = None
+        # Profiles the generation of the next few requests when armed through the metrics endpoint (see startMetrics())
+        self.profiler = RequestProfiler()
+        self.modelTask : asyncio.Task = None
+        # With "liveIngestion" on in config.json, every message in the configured channels is saved to Message.db as it arrives,
+        # so the training data stays current without running scrape.py
+        self.liveIngestion = self.config.get("liveIngestion", False)
+        self.ingester : MessageIngester = None
+        self.catchUpLock = asyncio.Lock()
+        self.unnamedAuthors : set[int] = set()  # authors missing from names.json, so they are only warned about once
+        self.firstReply = True
+        # Personas the bot can respond as, by the name used after "/kc". Their models are loaded when first used, and the least recently used
+        # ones are unloaded once they take up more than "modelCacheMB" in config.json (see ModelCache).
+        self.personas = self.config.get("personas", {})
+        self.personaConfigs = {userID: personaConfig(self.config, userID) for userID in getPersonaIDs(self.config)}
+        # The persona each recent "/kc" message asked for, by messageid, so our replies to them are shown under that persona's name
+        self.commandPersonas : OrderedDict[int, int] = OrderedDict()
+        # The most recent messages in each configured channel that fit in the token budget, keyed by messageid (see ContextWindow).
+        # The training data is built with the same budget, so the model gets as much chat history as it was trained with.
+        # This is kept up to date from message events, so building the chat history for a response needs no requests to Discord.
+        self.contextTokens = self.config.get("contextTokenBudget", DEFAULT_CONTEXT_TOKENS)
+        self.historyLength = self.config.get("historyLength", 50)  # Most messages to fetch from Discord to fill a chat history
+        self.histories : dict[int, ContextWindow] = {channelID: ContextWindow(self.contextTokens) for channelID in self.channelIDs}
+        self.msgCosts = MsgCostCounter()
+        # Streaming settings are optional in config.json. When streaming, the reply is posted once its first sentence is ready and edited as it grows.
+        self.streamResponses = self.config.get("streamResponses", False)
+        self.streamSequences = self.config.get("streamSequences", 1)            # Number of responses to generate when streaming (only the first is sent)
+        self.streamEditInterval = self.config.get("streamEditInterval", 1.0)    # Least number of seconds between edits of a streamed reply
+        self.streamFirstChars = self.config.get("streamFirstChars", 100)        # Post the reply after this many characters, even if the first sentence isn't done
+    
+    sentenceEndRegex = re.compile(r"[.!?]\s|\n")
     
+    async def setup_hook(self):
+        # Generation settings are optional in config.json
+        self.queue = GenerationQueue(maxConcurrent = self.config.get("maxConcurrentGenerations", 1),
+                                     maxQueued = self.config.get("maxQueuedRequests", 20),
+                                     timeout = self.config.get("generationTimeout", 300),
+                                     maxBatchSize = self.config.get("maxBatchSize", 4),
+                                     batchWindow = self.config.get("batchWindowMs", 50) / 1000,
+                                     ready = False,     # /kc requests wait in the queue until the model is loaded
+                                     profiler = self.profiler)
+        startMetrics(self.config, self.profiler)    # optional metrics endpoint & log line, see config.json
+        # Set once the tokenizer is loaded. Messages can't go into the history buffers before then, since their token cost is needed.
+        self.tokenizerReady = asyncio.Event()
+    
+    async def loadModel(self):
+        """Loads the tokenizer (which the history buffers need first), then loads & warms up the model in the background
+        and lets the queued requests through
+        """
+        try:
+            await asyncio.to_thread(load_tokenizer)
+        except Exception as e:
+            print(f"ERROR - Loading the tokenizer failed: {e!r}")
+        self.tokenizerReady.set()
+        await self.queue.setup(init_model)
+        print(f"Model ready {time.perf_counter() - startTime:.1f}s after startup")
+
     async def on_ready(self):
+        print(f'Connected {time.perf_counter() - startTime:.1f}s after startup')
+        if self.modelTask is None:  # on_ready is called again after reconnecting
+            self.modelTask = asyncio.create_task(self.loadModel())
         print(f'Logged in as {self.user} (ID: {self.user.id})')
         print(f'Guild: "{self.get_guild(self.guildID)}"')
         print('------')
+        # Ingestion is set up first, so new messages are saved no matter what happens while filling the history buffers
+        if self.liveIngestion:
+            if self.ingester is None:
+                (con, cur) = initDB()
+                self.ingester = MessageIngester(con, cur, self.names, self.config)
+            asyncio.create_task(self.catchUp())
         print(f'Chatbot enabled in the following channels:')
         for channel in self.channelIDs:
             print(self.get_channel(channel))
+            await self.backfillHistory(self.get_channel(channel))
         print('------')
 
+    async def catchUp(self):
+        """Saves the messages sent while the bot was offline to Message.db, in the background. Catch-ups after reconnecting wait their turn."""
+        async with self.catchUpLock:
+            print('Catching up on messages sent while offline...')
+            try:
+                await self.ingester.catchUp([self.get_channel(channel) for channel in self.channelIDs])
+            except Exception as e:
+                print(f"ERROR - Catching up on messages failed: {e!r}")
+                return
+            print('Saving new messages to Message.db')
+
+    def formatHistoryMsg(self, message : dc.Message) -> tuple[str, int]:
+        """Returns a message cleaned & formatted for the chat history (or "" if it has no content after cleaning), and its token cost"""
+        return self.formatHistoryContent(message.content, message.author.id, None if message.reference is None else message.reference.message_id)
+
+    def formatHistoryContent(self, content : str, authorID : int, referenceID : int | None) -> tuple[str, int]:
+        """Same as formatHistoryMsg(), from the parts of a message (e.g. from a raw event, when there is no dc.Message).
+        `referenceID` is the ID of the message it replies to, if any.
+        """
+        with metrics.timer("chat_format_seconds"):
+            messageContent = cleanMsg(content, str(authorID), self.names, self.config)
+            if messageContent == "":
+                return ("", 0)
+            config = self.config
+            # Our replies go under the name of the persona that sent them. (Replies from before the bot started go under userToImpersonateID.)
+            if authorID == self.config["botID"] and referenceID is not None:
+                config = self.personaConfigs.get(self.commandPersonas.get(referenceID), self.config)
+            try:
+                formattedMsg = formatMsg(messageContent, str(authorID), self.names, config)
+            except KeyError:    # left out of the chat history, since the model wasn't trained with a name for them
+                if authorID not in self.unnamedAuthors:
+                    self.unnamedAuthors.add(authorID)
+                    print(f"WARNING - User {authorID} has no name in names.json, so their messages are left out of the chat history")
+                return ("", 0)
+            return (formattedMsg, self.msgCosts.cost(formattedMsg, messageContent))
+
+    async def fetchHistory(self, channel : dc.TextChannel) -> ContextWindow:
+        """Returns the most recent messages in a channel that fit in the token budget, fetched from Discord"""
+        msgs = [msg async for msg in channel.history(limit=self.historyLength, oldest_first=False)]
+        await self.tokenizerReady.wait()
+        history = ContextWindow(self.contextTokens)
+        for msg in reversed(msgs):
+            history.append(*self.formatHistoryMsg(msg), key=msg.id)
+        return history
+
+    async def backfillHistory(self, channel : dc.TextChannel):
+        """Fills a channel's history buffer with its most recent messages. Messages that arrived while this was running are kept."""
+        backfill = await self.fetchHistory(channel)
+        newestID = max(backfill.keys(), default=0)
+        for (messageid, formattedMsg, cost) in self.histories[channel.id].messages:
+            if messageid > newestID:
+                backfill.append(formattedMsg, cost, key=messageid)
+        self.histories[channel.id] = backfill
+
+    # Raw events are used, since on_message_edit & on_message_delete are only called for messages that are still in discord.py's cache,
+    # which the messages fetched by backfillHistory() and catchUp() never are
+    async def on_raw_message_edit(self, payload: dc.RawMessageUpdateEvent):
+        if payload.channel_id not in self.channelIDs or "content" not in payload.data or "author" not in payload.data:
+            return  # not a content edit (e.g. an embed was added)
+        authorID = int(payload.data["author"]["id"])
+        history = self.histories.get(payload.channel_id)
+        if history is not None:
+            await self.tokenizerReady.wait()
+            reference = payload.data.get("message_reference") or {}
+            referenceID = int(reference["message_id"]) if "message_id" in reference else None
+            history.replace(payload.message_id, *self.formatHistoryContent(payload.data["content"], authorID, referenceID))
+        if self.ingester is not None:
+            self.ingester.edit(payload.message_id, authorID, payload.data["content"])
+
+    async def on_raw_message_delete(self, payload: dc.RawMessageDeleteEvent):
+        if payload.channel_id not in self.channelIDs:
+            return
+        history = self.histories.get(payload.channel_id)
+        if history is not None:
+            history.remove(payload.message_id)
+        if self.ingester is not None:
+            self.ingester.delete(payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload: dc.RawBulkMessageDeleteEvent):
+        if payload.channel_id not in self.channelIDs:
+            return
+        history = self.histories.get(payload.channel_id)
+        for messageid in payload.message_ids:
+            if history is not None:
+                history.remove(messageid)
+            if self.ingester is not None:
+                self.ingester.delete(messageid)
+
     async def on_message(self, message: dc.Message):
+        # Save every message in our channels to db, even ones that can't be formatted for the chat history below
+        if self.ingester is not None and message.channel.id in self.channelIDs:
+            self.ingester.add(message)
+        # Keep track of every message in our channels (including our own), for the chat history of future responses
+        if message.channel.id in self.histories:
+            await self.tokenizerReady.wait()
+            self.histories[message.channel.id].append(*self.formatHistoryMsg(message), key=message.id)
+        
         # we do not want the bot to reply to itself
         if message.author.id == self.user.id:
             return
 
         if message.content.startswith('/kc'):
+            metrics.count("chat_requests_total")
+            requestStart = time.perf_counter()
+            # "/kc <persona> ..." responds as that persona, and plain "/kc ..." as userToImpersonateID
+            personaName = getPersonaCommand(message.content, self.personas)
+            persona = self.personas[personaName] if personaName is not None else self.config["userToImpersonateID"]
+            self.commandPersonas[message.id] = persona
+            while len(self.commandPersonas) > self.historyLength:
+                self.commandPersonas.popitem(last=False)
             
-            # we want the bot to ignore messages if it is currently generating a response
-            if self.is_generating:
-                return
-            
-            self.is_generating = True
             async with message.channel.typing(): # start typing to let users know a response is coming
                 
-                # Get the recent message history, cleaned and formatted
-                msgHistory = []
-                async for msg in message.channel.history(limit=10):
-                    messageContent = cleanMsg(msg.content, str(msg.author.id), self.names, self.config)
-                    if messageContent != "":
-                        msgHistory.append(formatMsg(messageContent, str(msg.author.id), self.names, self.config))
-                # combine the messages into a single input string
-                msgHistoryStr = "\n".join(reversed(msgHistory))
-                responses = generate_message(msgHistoryStr) # Array of generated responses
+                # Get the recent message history, cleaned and formatted, and combine it into a single input string
+                if message.channel.id in self.histories:
+                    with metrics.timer("chat_history_seconds", source="buffer"):
+                        msgHistoryStr = self.histories[message.channel.id].text()
+                else:   # channels not in config.json have no history buffer, so ask Discord for their history
+                    with metrics.timer("chat_history_seconds", source="discord"):
+                        msgHistoryStr = (await self.fetchHistory(message.channel)).text()
+                if self.streamResponses:
+                    await self.streamResponse(message, msgHistoryStr, persona)
+                    metrics.observe("chat_response_seconds", time.perf_counter() - requestStart)
+                    return
+                # wait for our turn to generate responses, without blocking the bot from handling other events
+                try:
+                    responses = await self.queue.submit(message.channel.id, msgHistoryStr, persona=persona) # Array of generated responses
+                except asyncio.TimeoutError:
+                    metrics.count("chat_timeouts_total")
+                    print(f"WARNING - Generating a response in {message.channel} timed out")
+                    return
                 print(msgHistoryStr + "\n")
                 testprint(responses)
                 await message.reply(responses[0], mention_author=True) # reply with the first of the generated response
-            self.is_generating = False
+                metrics.observe("chat_response_seconds", time.perf_counter() - requestStart)
+                self.printFirstReply()
+
+    def printFirstReply(self):
+        if self.firstReply:
+            self.firstReply = False
+            print(f"First reply sent {time.perf_counter() - startTime:.1f}s after startup")
+
+    async def streamResponse(self, message : dc.Message, msgHistoryStr : str, persona : int):
+        """Replies to a message with a response that is posted as soon as its first sentence is generated,
+        then edited as the rest of it is generated.
+
+        Args:
+            `message` : Message to reply to
+            `msgHistoryStr` : Chat history to respond to (see generate_message())
+            `persona` : User ID of the persona to respond as
+        """
+        loop = asyncio.get_running_loop()
+        textQueue = asyncio.Queue()
+        task = asyncio.create_task(self.queue.submit(message.channel.id, msgHistoryStr, persona = persona,
+                                                     streamer = ResponseStreamer(loop, textQueue),
+                                                     num_return_sequences = self.streamSequences))
+        task.add_done_callback(lambda _: textQueue.put_nowait(None))    # stop waiting for text if generation fails or times out
+        
+        reply = None
+        text = ""
+        lastEdit = 0
+        while (newText := await textQueue.get()) is not None:
+            text += newText
+            if reply is None:
+                # Post the reply once the first sentence is done (or it is getting long without one)
+                if text.strip() != "" and (self.sentenceEndRegex.search(text.lstrip()) or len(text) >= self.streamFirstChars):
+                    reply = await message.reply(text, mention_author=True)
+                    lastEdit = loop.time()
+            elif loop.time() - lastEdit >= self.streamEditInterval:   # edits are throttled to stay within Discord's rate limits
+                await reply.edit(content=text)
+                lastEdit = loop.time()
+        
+        try:
+            responses = await task
+        except asyncio.TimeoutError:
+            metrics.count("chat_timeouts_total")
+            print(f"WARNING - Generating a response in {message.channel} timed out")
+            return
+        print(msgHistoryStr + "\n")
+        testprint(responses)
+        # Make sure the reply ends up as the whole of the first response
+        if reply is None:
+            await message.reply(responses[0], mention_author=True)
+        elif reply.content != responses[0]:
+            await reply.edit(content=responses[0])
+        self.printFirstReply()
 
 # Code for running chat bot
 def runChatBot():
@@ -61,39 +409,347 @@ def runChatBot():
 # ----------------------------------------------------------------------------------
 
 
-model = 'model.bin'         # replace this with the dir of the checkpoint/model you want to chat with
-#model = transformers.AutoModelForCausalLM.from_pretrained("facebook/opt-350m")
-tokenizer = transformers.AutoTokenizer.from_pretrained("facebook/opt-350m")
+model_loc = 'model.bin'     # replace this with the dir of the checkpoint/model you want to chat with
+#model_loc = "facebook/opt-350m"
+# (The models of the other personas in config.json are loaded from where train.py saves them, e.g. "model-<userID>.bin". See personaPath().)
+device = "cpu"              # change this to "cuda" to use your GPU instead (fp32 backend only)
+tokenizer = None            # loaded by load_tokenizer()
+model_cache = None          # made by set_backend()
+inference_backend = None
+
+# How the model is run. Set "inferenceBackend" in config.json to choose one (see bench.py's "backends" benchmark to compare them):
+#   "fp32" : the checkpoint as it is, with PyTorch
+#   "int8" : the checkpoint with its linear layers dynamically quantized to int8, with PyTorch. Smaller and usually faster on CPU.
+#   "onnx" : the checkpoint exported to ONNX and run with ONNX Runtime. Needs `pip install optimum[onnxruntime]`.
+#            The export is saved next to the checkpoint (as "<model_loc>-onnx") the first time, and reused after that.
+INFERENCE_BACKENDS = ["fp32", "int8", "onnx"]
 
-generator = transformers.pipeline(
-        task = 'text-generation',
-        model = model,
-        tokenizer = tokenizer,
-        device = "cpu",         # change this to an int to use the GPU of that ordinal rank instead (0 if you have one GPU)
-        max_new_tokens = 200,   # Hard limit to the amount of new tokens the AI can generate.
+def load_tokenizer():
+        """Loads the tokenizer, if it isn't already. It is also used to count the tokens of the chat history (see countTokens()),
+        so hold tokenizerLock while using it.
+        """
+        global tokenizer
+        if tokenizer is None:
+                import transformers
+                # Prompts are padded on the left, so the responses to a batch of prompts all start at the same position
+                tokenizer = transformers.AutoTokenizer.from_pretrained(TOKENIZER_NAME, padding_side = "left")
+                generation_kwargs["pad_token_id"] = tokenizer.pad_token_id
+                setMsgTokenizer(tokenizer)
+
+def load_model(modelLoc : str, backend : str = "fp32"):
+        """Loads a checkpoint to run with the given inference backend (one of INFERENCE_BACKENDS), ready for generation"""
+        import torch
+        import transformers
+        if backend == "fp32":
+                model = transformers.AutoModelForCausalLM.from_pretrained(modelLoc)
+                model.eval()
+                return model.to(device)
+        elif backend == "int8":
+                model = transformers.AutoModelForCausalLM.from_pretrained(modelLoc)
+                model.eval()
+                # Weights are stored as int8, and activations are quantized on the fly. Only works on the CPU.
+                return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype = torch.qint8)
+        elif backend == "onnx":
+                try:
+                        from optimum.onnxruntime import ORTModelForCausalLM
+                except ImportError:
+                        raise ImportError('The "onnx" inference backend needs optimum with ONNX Runtime: pip install optimum[onnxruntime]')
+                exportLoc = onnx_export_loc(modelLoc)
+                if os.path.isdir(exportLoc):
+                        return ORTModelForCausalLM.from_pretrained(exportLoc)
+                model = ORTModelForCausalLM.from_pretrained(modelLoc, export = True)
+                model.save_pretrained(exportLoc)
+                return model
+        raise ValueError(f'Unknown inference backend "{backend}", expected one of {INFERENCE_BACKENDS}')
+
+def onnx_export_loc(modelLoc : str) -> str:
+        return modelLoc.rstrip("/\\") + "-onnx"
+
+def files_size(path : str) -> int:
+        """Returns the total size in bytes of a file, or of all files in a directory (0 if it doesn't exist)"""
+        if os.path.isfile(path):
+                return os.path.getsize(path)
+        return sum(os.path.getsize(os.path.join(dirPath, fileName)) for (dirPath, _, fileNames) in os.walk(path) for fileName in fileNames)
+
+def model_size(model, modelLoc : str) -> int:
+        """Returns roughly how many bytes of memory a model loaded by load_model() takes up"""
+        if not hasattr(model, "state_dict"):    # ONNX Runtime holds the exported weights
+                return files_size(onnx_export_loc(modelLoc))
+        size = 0
+        for value in model.state_dict().values():
+                # int8 linear layers store their (weight, bias) as a tuple
+                for tensor in (value if isinstance(value, tuple) else (value,)):
+                        if hasattr(tensor, "element_size"):
+                                size += tensor.numel() * tensor.element_size()
+        return size
+
+class CachedModel:
+        """A model loaded by ModelCache, with its own cache of the prompt prefix's keys/values (see get_prefix_cache())"""
+        def __init__(self, model, size : int):
+                self.model = model
+                self.size = size
+                # The model's past keys/values for the prompt prefix (everything before the chat history), which is the same for every request.
+                # Computed the first time it is needed, and again only if the prefix changes (e.g. the persona's name in names.json is changed).
+                self.prefix = None
+                self.prefixIDs = None
+                self.past = None
+                self.prefixLock = threading.Lock()
+
+class ModelCache:
+        """Keeps the most recently used models loaded, so one process can chat as several personas.
+        Models are loaded on demand (on the worker thread that needs them), and the least recently used ones are unloaded
+        to make room for a new one once the loaded models would take up more than `maxBytes`.
+        Room is made before loading, using the size the model had last time (or the size of its checkpoint on disk the first time).
+        (A model that is unloaded while another worker thread is still generating with it is only freed once that thread is done.)
+
+        Args:
+            `maxBytes` : Most memory the loaded models may take up in total. A model bigger than this is still loaded, on its own.
+            `backend` : Inference backend to load models with (one of INFERENCE_BACKENDS)
+        """
+        def __init__(self, maxBytes : int, backend : str):
+                self.maxBytes = maxBytes
+                self.backend = backend
+                self.models : OrderedDict[str, CachedModel] = OrderedDict()    # model location -> model, least recently used first
+                self.sizes : dict[str, int] = {}                                # model location -> size when it was last loaded
+                self.lock = threading.Lock()
+                self.loadLocks : dict[str, threading.Lock] = {}                 # one per model location, so each model is only loaded once
+
+        def get(self, modelLoc : str) -> CachedModel:
+                """Returns the model at modelLoc, loading it first if it isn't loaded"""
+                with self.lock:
+                        if modelLoc in self.models:
+                                self.models.move_to_end(modelLoc)
+                                return self.models[modelLoc]
+                        loadLock = self.loadLocks.setdefault(modelLoc, threading.Lock())
+                # Other threads can keep using the loaded models while this one loads
+                with loadLock:
+                        with self.lock:
+                                if modelLoc in self.models:     # another thread loaded it while this one waited
+                                        self.models.move_to_end(modelLoc)
+                                        return self.models[modelLoc]
+                                self.evict(self.sizes.get(modelLoc) or files_size(modelLoc))
+                        start = time.perf_counter()
+                        model = load_model(modelLoc, self.backend)
+                        cached = CachedModel(model, model_size(model, modelLoc))
+                        with self.lock:
+                                self.models[modelLoc] = cached
+                                self.sizes[modelLoc] = cached.size
+                                self.evict(0)
+                        print(f"Loaded {modelLoc} ({self.backend}, {cached.size / 2**20:,.0f} MiB) in {time.perf_counter() - start:.1f}s. " +
+                              f"{len(self.models)} model(s) loaded, {self.loadedBytes() / 2**20:,.0f} MiB in total")
+                        return cached
+
+        def loadedBytes(self) -> int:
+                return sum(cached.size for cached in self.models.values())
+
+        def evict(self, room : int):
+                """Unloads the least recently used models until there are `room` bytes to spare (always keeping the most recently used one
+                when room is 0). Call with self.lock held.
+                """
+                while len(self.models) > (0 if room > 0 else 1) and self.loadedBytes() + room > self.maxBytes:
+                        (modelLoc, _) = self.models.popitem(last = False)
+                        print(f"Unloaded {modelLoc} to make room for another model")
+
+        def clear(self):
+                """Unloads every model"""
+                with self.lock:
+                        self.models.clear()
+
+def persona_model_loc(persona : int, config : dict[str, (str | int | list[int])]) -> str:
+        """Returns where the model of a persona (a user ID) is loaded from"""
+        return personaPath(model_loc, persona, config)
+
+def get_model(persona : int = None) -> CachedModel:
+        """Returns the model of a persona (userToImpersonateID if not given), loading it if it isn't already"""
+        if model_cache is None:
+                init_model(warmUp = False)
+        config = getConfig()
+        return model_cache.get(persona_model_loc(config["userToImpersonateID"] if persona is None else persona, config))
+
+def set_backend(backend : str):
+        """Switches the inference backend that generate_messages() uses, unloading all models loaded with the previous one,
+        then loads the model of userToImpersonateID with it. "modelCacheMB" in config.json sets how much memory loaded models may take up.
+        """
+        global model_cache, inference_backend
+        config = getConfig()
+        if model_cache is not None:
+                model_cache.clear()
+        model_cache = ModelCache(config.get("modelCacheMB", 4096) * 2**20, backend)
+        inference_backend = backend
+        model_cache.get(persona_model_loc(config["userToImpersonateID"], config))
+
+generation_kwargs = dict(
+        max_new_tokens = 200,           # Hard limit to the amount of new tokens the AI can generate.
         exponential_decay_length_penalty = (20, 1.05),  # Increase penalty by given exponent for each new token generated after 20th token (to keep messages short)
+        do_sample = True,               # Required for AI to keep track of context when generating text.
+        num_return_sequences = 10,      # Number of responses generated
+        temperature = 0.8,              # Value from 0-1. Lower temperature gives more random but less intelligible results, while higher is more predictable.
+        pad_token_id = None,            # set by load_tokenizer()
 )
 
-def generate_message(inputText : str) -> str:
-        name = getNames()[str(getConfig()["userToImpersonateID"])]
-        prompt = f"You are {name} in a chat room with some friends. You chat unfiltered, and saying rude things, cracking jokes, and swearing are encouraged."
+use_prefix_cache = True        # Reuse the model's keys/values for the fixed "### Instruction:" part of the prompt instead of recomputing them every time
+
+def get_prefix_cache(cached : CachedModel, prefix : str) -> tuple["torch.Tensor", tuple[tuple["torch.Tensor", "torch.Tensor"], ...]]:
+        """Returns the token IDs (shape (1, length)) and past keys/values (one (key, value) pair per layer) of a model's prompt prefix"""
+        import torch
+        with cached.prefixLock:
+                if cached.prefix != prefix:
+                        with tokenizerLock:
+                                prefixIDs = tokenizer(prefix, return_tensors = "pt")["input_ids"].to(cached.model.device)
+                        with torch.no_grad():
+                                past = cached.model(input_ids = prefixIDs, use_cache = True).past_key_values
+                        if hasattr(past, "to_legacy_cache"):
+                                past = past.to_legacy_cache()
+                        (cached.prefix, cached.prefixIDs, cached.past) = (prefix, prefixIDs, past)
+                return (cached.prefixIDs, cached.past)
 
-        text = f"""### Instruction:
-{prompt}
+def expand_prefix_cache(past : tuple[tuple["torch.Tensor", "torch.Tensor"], ...], batchSize : int):
+        """Returns a fresh copy of the prefix keys/values for `batchSize` sequences, in the cache format model.generate() expects"""
+        import transformers
+        expanded = tuple((key.expand(batchSize, -1, -1, -1).contiguous(), value.expand(batchSize, -1, -1, -1).contiguous()) for (key, value) in past)
+        if hasattr(transformers, "DynamicCache"):
+                return transformers.DynamicCache.from_legacy_cache(expanded)
+        return expanded
+
+model_init_lock = threading.Lock()
+
+def init_model(warmUp : bool = True):
+        """Loads the tokenizer and the model of userToImpersonateID (with the "inferenceBackend" from config.json), if they aren't already.
+        With `warmUp`, also generates a few tokens, so the first real request doesn't pay for one-time setup (e.g. the prefix cache).
+        """
+        with model_init_lock:
+                load_tokenizer()
+                if model_cache is None:
+                        set_backend(getConfig().get("inferenceBackend", "fp32"))
+        if warmUp:
+                generate_messages(["Tom: hi\nJeremy: hey, what's up?"], max_new_tokens = 4, num_return_sequences = 1)
+
+def generate_messages(inputTexts : list[str], usePrefixCache : bool = None, persona : int = None, **kwargs) -> list[list[str]]:
+        """Generates responses to several chat histories at once, in a single batched call to the model.
+        Returns a list of generated responses for each input text, in the same order.
+
+        Args:
+            `inputTexts` : Chat histories to respond to
+            `usePrefixCache` = `None` : Whether to reuse the cached keys/values of the prompt prefix. Defaults to use_prefix_cache (never with the "onnx" backend).
+             (The ONNX export computes its keys/values itself, so it can't start from the cached prefix.)
+            `persona` = `None` : User ID of the persona to respond as (userToImpersonateID if not given). Its model is loaded if it isn't already.
+            `**kwargs` : Overrides for generation_kwargs
+        """
+        import torch
+        start = time.perf_counter()
+        config = getConfig()
+        if persona is None:
+                persona = config["userToImpersonateID"]
+        cached = get_model(persona)
+        model = cached.model
+        if usePrefixCache is None:
+                usePrefixCache = use_prefix_cache and inference_backend != "onnx"
+        kwargs = {**generation_kwargs, **kwargs}
+        n = kwargs["num_return_sequences"]
+        prefix = f"""### Instruction:
+{getPrompt(getNames(), personaConfig(config, persona))}
 
 ### Input:
-{inputText}
+"""
+        suffixes = [f"""{inputText}
 
 ### Response:
-"""
-        completedText = generator(
-                text_inputs = text,
-                return_full_text = False,       # Only return the added text
-                do_sample = True,               # Required for AI to keep track of context when generating text.
-                num_return_sequences = 10,      # Number of responses generated
-                temperature = 0.8,             # Value from 0-1. Lower temperature gives more random but less intelligible results, while higher is more predictable.
-                )
-        return [x['generated_text'] for x in completedText]
+""" for inputText in inputTexts]
+
+        if usePrefixCache:
+                # Sequences are laid out as [prefix][padding][chat history & response label], so the prefix is at the same position in all of them.
+                # OPT works out token positions from the attention mask, so the padding in the middle doesn't shift anything.
+                (prefixIDs, past) = get_prefix_cache(cached, prefix)
+                with metrics.timer("chat_tokenize_seconds"), tokenizerLock:
+                        suffix = tokenizer(suffixes, add_special_tokens = False, return_tensors = "pt", padding = True).to(model.device)
+                inputIDs = torch.cat([prefixIDs.expand(len(inputTexts), -1), suffix["input_ids"]], dim = 1)
+                attentionMask = torch.cat([torch.ones_like(prefixIDs).expand(len(inputTexts), -1), suffix["attention_mask"]], dim = 1)
+                inputs = dict(input_ids = inputIDs, attention_mask = attentionMask,
+                              past_key_values = expand_prefix_cache(past, len(inputTexts) * n))   # one copy for each returned sequence
+        else:
+                with metrics.timer("chat_tokenize_seconds"), tokenizerLock:
+                        inputs = tokenizer([prefix + suffix for suffix in suffixes], return_tensors = "pt", padding = True).to(model.device)
+        timer = GenerationTimer(start, kwargs.get("streamer"))
+        kwargs["streamer"] = timer
+        generateStart = time.perf_counter()
+        with torch.no_grad():
+                outputIDs = model.generate(**inputs, **kwargs)
+        generateSeconds = time.perf_counter() - generateStart
+        newIDs = outputIDs[:, inputs["input_ids"].shape[1]:]
+        # Every sequence is padded to the length of the longest one, so only count the tokens that aren't padding
+        newTokens = int((newIDs != kwargs["pad_token_id"]).sum()) if kwargs["pad_token_id"] is not None else newIDs.numel()
+        metrics.observe("chat_generate_seconds", generateSeconds)
+        metrics.observe("chat_tokens_per_second", newTokens / generateSeconds, RATE_BUCKETS)
+        metrics.count("chat_generated_tokens_total", newTokens)
+        if timer.firstTokenSeconds is not None:
+                metrics.observe("chat_time_to_first_token_seconds", timer.firstTokenSeconds)
+        # Only return the added text
+        with metrics.timer("chat_detokenize_seconds"), tokenizerLock:
+                completedText = tokenizer.batch_decode(newIDs, skip_special_tokens = True)
+        return [completedText[i * n:(i + 1) * n] for i in range(len(inputTexts))]
+
+def generate_message(inputText : str) -> list[str]:
+        """Returns a list of generated responses to the given chat history"""
+        return generate_messages([inputText])[0]
+
+class ResponseStreamer:
+        """Streamer for model.generate() that puts the text of the first generated sequence on an asyncio queue as it is generated,
+        then None once generation is done. Works with any number of returned sequences, unlike transformers' own text streamers.
+        (It has the same put()/end() methods as transformers' BaseStreamer, without importing transformers to subclass it.)
+
+        Args:
+            `loop` : Event loop that `textQueue` belongs to (generation runs on a worker thread)
+            `textQueue` : Queue to put each new piece of text on
+        """
+        def __init__(self, loop : asyncio.AbstractEventLoop, textQueue : asyncio.Queue):
+                self.loop = loop
+                self.textQueue = textQueue
+                self.tokenIDs = []
+                self.sentText = ""
+                self.promptSkipped = False
+
+        def put(self, value : "torch.Tensor"):
+                if not self.promptSkipped:      # the first call is the prompt, which isn't part of the response
+                        self.promptSkipped = True
+                        return
+                self.tokenIDs.extend(value.reshape(value.shape[0], -1)[0].tolist())
+                with tokenizerLock:
+                        text = tokenizer.decode(self.tokenIDs, skip_special_tokens = True)
+                if text.endswith("\ufffd"):    # wait for the rest of a character that is split across tokens
+                        return
+                if len(text) > len(self.sentText):
+                        newText = text[len(self.sentText):]
+                        self.sentText = text
+                        self.loop.call_soon_threadsafe(self.textQueue.put_nowait, newText)
+
+        def end(self):
+                self.loop.call_soon_threadsafe(self.textQueue.put_nowait, None)
+
+class GenerationTimer:
+        """Streamer for model.generate() that records when the first new token is generated, and passes everything on to another streamer (if any).
+        Works with any number of sequences.
+
+        Args:
+            `start` : perf_counter() time that the time to first token is measured from
+            `streamer` = `None` : Streamer to pass the tokens on to (e.g. a ResponseStreamer)
+        """
+        def __init__(self, start : float, streamer = None):
+                self.start = start
+                self.streamer = streamer
+                self.firstTokenSeconds = None
+                self.promptSkipped = False
+
+        def put(self, value : "torch.Tensor"):
+                if not self.promptSkipped:      # the first call is the prompt
+                        self.promptSkipped = True
+                elif self.firstTokenSeconds is None:
+                        self.firstTokenSeconds = time.perf_counter() - self.start
+                if self.streamer is not None:
+                        self.streamer.put(value)
+
+        def end(self):
+                if self.streamer is not None:
+                        self.streamer.end()
 
 def testprint(msgs : list[str]):
     for msg in msgs:
@@ -124,4 +780,5 @@ Rhett: counter point, just make it think that it has schizophrenia. badger"""
 #testprint(generate_message(testmsg2))
 
 # Use this line if you want the bot to run in discord and respond to messages
-runChatBot()
\ No newline at end of file
+if __name__ == "__main__":
+    runChatBot()
@@ -4,6 +4,18 @@ import re
 import json
 import discord as dc
 import datetime
+import zlib
+import bisect
+import contextlib
+import cProfile
+import http.server
+import io
+import pstats
+import threading
+import time
+import urllib.parse
+from collections import deque
+from typing import Iterable, Iterator
 # Kaycee bot requires the 'message_content' intent to be enabled.
 
 def getConfig() -> dict[str, (str | int | list[int])]:
@@ -20,9 +32,45 @@ def getConfig() -> dict[str, (str | int | list[int])]:
     for channel in config['channelIDs']:
         channelIDs.append(int(channel))
     config['channelIDs'] = channelIDs
+    # optional: other users the bot can impersonate, as {"name": "userID"}. "/kc <name>" chats as that user.
+    if 'personas' in config:
+        config['personas'] = {name.lower(): int(userID) for (name, userID) in config['personas'].items()}
     return config
 
 
+def getPersonaIDs(config : dict[str, (str | int | list[int])]) -> list[int]:
+    """Returns the user IDs of every persona the bot can impersonate: userToImpersonateID first, then the "personas" in config.json"""
+    userIDs = [config["userToImpersonateID"]]
+    for userID in config.get("personas", {}).values():
+        if userID not in userIDs:
+            userIDs.append(userID)
+    return userIDs
+
+
+def personaConfig(config : dict[str, (str | int | list[int])], userID : int) -> dict[str, (str | int | list[int])]:
+    """Returns a copy of config that impersonates the given user, for use with getPrompt(), formatMsg(), etc."""
+    return {**config, "userToImpersonateID": userID}
+
+
+def personaPath(path : str, userID : int, config : dict[str, (str | int | list[int])]) -> str:
+    """Returns the path of a persona's version of a file (dataset, model, etc).
+    This is `path` itself for userToImpersonateID, so setups with only one persona keep their files where they were,
+    and `path` with "-<userID>" added before the extension for any other persona (e.g. "model.bin" -> "model-1234.bin").
+    """
+    if userID == config["userToImpersonateID"]:
+        return path
+    (root, extension) = os.path.splitext(path)
+    return f"{root}-{userID}{extension}"
+
+
+def getPersonaCommand(msgContent : str, personas : dict[str, int]) -> str | None:
+    """Returns the persona name a "/kc <persona> ..." message asks for (a key of `personas`), or None if it doesn't name one"""
+    words = msgContent.split(maxsplit=2)
+    if len(words) >= 2 and words[0] == "/kc" and words[1].lower() in personas:
+        return words[1].lower()
+    return None
+
+
 def getNames() -> dict[str, str]:
     """Reads preferred names from names.json file.
     id/name pairs in names.json can be for channels, roles, or users.
@@ -62,6 +110,9 @@ class Message:
         self.replyid = dbRow[7]
         self.conversid = dbRow[8]
         self.isFirstInConvers = dbRow[9]
+        self.cleanver = dbRow[10]
+        self.sent_ms = dbRow[11]
+        self.tokencount = dbRow[12]
         
         
 def getDateTime(message : Message) -> datetime.datetime:
@@ -70,38 +121,42 @@ def getDateTime(message : Message) -> datetime.datetime:
     Args:
         `message` : A Message class object
     """
-    message_date : datetime
-    try:                # Try getting message datetime with ms
-        message_date = datetime.datetime.strptime(message.sent, "%Y-%m-%d %H:%M:%S.%f%z")
-    except ValueError:  # If that doesn't work, get message datetime wihtout ms
-        message_date = datetime.datetime.strptime(message.sent, "%Y-%m-%d %H:%M:%S%z")
-    return message_date
+    return datetime.datetime.fromtimestamp(message.sent_ms / 1000, tz=datetime.timezone.utc)
 
 
-# DATABASE FUNCTIONS
+# Discord snowflake IDs hold the ms since the Discord epoch (the first second of 2015) in their upper 42 bits
+DISCORD_EPOCH_MS = 1420070400000
 
-def initDB() -> tuple[sqlite3.Connection, sqlite3.Cursor]:
-    """Connects to Message.db. Also handles creating/init any missing dir, db, or tables.
+def snowflakeToMs(snowflake : int) -> int:
+    """Returns the time a Discord ID (snowflake) was created, in ms since the Unix epoch.
+    For a message ID, this is when the message was sent.
     
-    Returns the Connection and Cursor objects for the connected database.
+    Args:
+        `snowflake` : Any Discord ID (message, user, channel, etc)
     """
-    
-    # Check for db directory. If it does not exist, create it.
-    if "db" not in os.listdir():
-        os.mkdir(path=os.getcwd() + os.sep + "db")
-        print("Directory 'db' was not found and was created locally")
+    return (snowflake >> 22) + DISCORD_EPOCH_MS
 
-    os.chdir(path=os.getcwd() + os.sep + "db")      # Change cwd to db
-    con = sqlite3.connect(database="Message.db")    # Estabish a connection w/ database
-    cur = con.cursor()                              # Create a Cursor
-    os.chdir(path=os.pardir)                        # Return cwd to parent dir for future operations
-    print("Connected to Message.db")
-    
-    # Selects the "Message" table from db
-    table = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name = 'Message';")
-    if table.fetchone() is None:  # Create the Message table if it is empty
-        cur.execute("CREATE TABLE Message(" +
-                    "messageid BIGINT," +
+
+# DATABASE FUNCTIONS
+
+# Pragmas applied to every connection. WAL lets readers and the writer work at the same time and makes commits much cheaper,
+# and synchronous=NORMAL is still crash-safe in WAL mode. The cache/mmap sizes are generous because Message.db can get big.
+DB_PRAGMAS = [
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -65536;",      # 64 MiB page cache (negative values are in KiB)
+    "PRAGMA mmap_size = 268435456;",    # 256 MiB memory-mapped I/O
+]
+
+
+def migrateToV1(cur : sqlite3.Cursor):
+    """Schema v1: makes messageid the primary key of the Message table and indexes the columns we filter & sort on.
+    Databases made before schema versioning are rebuilt in place, so no re-scrape is needed.
+    If a message was scraped more than once, only its first copy is kept.
+    """
+    createMessage = ("CREATE TABLE {}(" +
+                    "messageid INTEGER PRIMARY KEY," +
                     "channelid BIGINT," +
                     "channelname VARCHAR(200)," +
                     "userid BIGINT," +
@@ -111,13 +166,126 @@ def initDB() -> tuple[sqlite3.Connection, sqlite3.Cursor]:
                     "replyid BIGINT," +
                     "conversid BIGINT," +
                     "isFirstInConvers BOOLEAN);")
+    table = cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name = 'Message';")
+    if table.fetchone() is None:  # Create the Message table if it is empty
+        cur.execute(createMessage.format("Message"))
         print("Created 'Message' table in db")
+    else:                       # Otherwise rebuild the old (unkeyed) table with the new schema
+        cur.execute(createMessage.format("MessageV1"))
+        cur.execute("INSERT OR IGNORE INTO MessageV1 " +
+                    "SELECT messageid, channelid, channelname, userid, username, sent, content, replyid, conversid, isFirstInConvers " +
+                    "FROM Message ORDER BY rowid ASC;")
+        cur.execute("DROP TABLE Message;")
+        cur.execute("ALTER TABLE MessageV1 RENAME TO Message;")
+        print("Rebuilt 'Message' table with messageid as its primary key")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_message_channel_sent ON Message (channelid, sent);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_message_convers_sent ON Message (conversid, sent);")
+
+
+def migrateToV2(cur : sqlite3.Cursor):
+    """Schema v2: adds the cleanver column, which holds the MsgCleaner.version that last cleaned a message (0 = not cleaned yet).
+    This lets cleanAllData() skip messages that are already clean. Existing messages start at 0 and are cleaned once more.
+    """
+    cur.execute("ALTER TABLE Message ADD COLUMN cleanver INTEGER NOT NULL DEFAULT 0;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_message_cleanver ON Message (cleanver);")
+
+
+def migrateToV3(cur : sqlite3.Cursor):
+    """Schema v3: adds the sent_ms column, which holds when a message was sent as an integer (ms since the Unix epoch).
+    It is backfilled from the message IDs, and replaces "sent" in the indexes since it is much cheaper to sort & compare.
+    """
+    cur.execute("ALTER TABLE Message ADD COLUMN sent_ms INTEGER;")
+    cur.execute("UPDATE Message SET sent_ms = (messageid >> 22) + ?;", (DISCORD_EPOCH_MS,))
+    cur.execute("DROP INDEX IF EXISTS idx_message_channel_sent;")
+    cur.execute("DROP INDEX IF EXISTS idx_message_convers_sent;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_message_channel_sentms ON Message (channelid, sent_ms);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_message_convers_sentms ON Message (conversid, sent_ms);")
+
+
+def migrateToV4(cur : sqlite3.Cursor):
+    """Schema v4: adds the ScrapeCursor table, which holds the ID of the newest message saved from each channel.
+    The scraper commits it together with each chunk of messages, so an interrupted scrape picks up where it stopped.
+    It is backfilled with the newest message of each channel already in the database.
+    """
+    cur.execute("CREATE TABLE IF NOT EXISTS ScrapeCursor (channelid INTEGER PRIMARY KEY, lastmessageid INTEGER NOT NULL);")
+    cur.execute("INSERT OR REPLACE INTO ScrapeCursor (channelid, lastmessageid) SELECT channelid, MAX(messageid) FROM Message GROUP BY channelid;")
+
+
+def migrateToV5(cur : sqlite3.Cursor):
+    """Schema v5: adds the tokencount column, which caches how many tokens a message's content takes up (see countMsgTokens()).
+    NULL means it hasn't been counted yet; updateTokenCounts() fills these in, and they are reset to NULL whenever the content changes.
+    """
+    cur.execute("ALTER TABLE Message ADD COLUMN tokencount INTEGER;")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_message_tokencount_null ON Message (messageid) WHERE tokencount IS NULL;")
+
+
+# Schema migrations, in order. Running SCHEMA_MIGRATIONS[i] upgrades a database from schema version i to version i+1.
+# Never edit or reorder a migration that has already been released; append a new one instead.
+SCHEMA_MIGRATIONS = [
+    migrateToV1,
+    migrateToV2,
+    migrateToV3,
+    migrateToV4,
+    migrateToV5,
+]
+
+
+def migrateDB(con : sqlite3.Connection, cur : sqlite3.Cursor):
+    """Brings the connected database up to the latest schema version. Each migration runs in its own transaction,
+    so an interrupted upgrade is rolled back and simply retried next time.
+    The schema version is stored in the database itself (PRAGMA user_version).
+
+    Args:
+        `con` : Connection to database
+        `cur` : Cursor for connected database
+    """
+    version = cur.execute("PRAGMA user_version;").fetchone()[0]
+    if version > len(SCHEMA_MIGRATIONS):
+        raise RuntimeError(f"Message.db has schema version {version}, but this code only knows up to version {len(SCHEMA_MIGRATIONS)}")
+    
+    for newVersion in range(version + 1, len(SCHEMA_MIGRATIONS) + 1):
+        con.commit()                # make sure no implicit transaction is open before starting our own
+        try:
+            cur.execute("BEGIN;")
+            SCHEMA_MIGRATIONS[newVersion - 1](cur)
+            cur.execute(f"PRAGMA user_version = {newVersion};")
+            con.commit()
+        except:
+            con.rollback()
+            print(f"ERROR - Failed to migrate Message.db to schema version {newVersion}")
+            raise
+        print(f"Migrated Message.db to schema version {newVersion}")
+    if version < len(SCHEMA_MIGRATIONS):
+        cur.execute("PRAGMA optimize;")     # refresh query planner statistics for the new indexes
+
+
+def initDB() -> tuple[sqlite3.Connection, sqlite3.Cursor]:
+    """Connects to Message.db. Also handles creating/init any missing dir, db, or tables,
+    and upgrading databases made by older versions of this code to the latest schema.
+    
+    Returns the Connection and Cursor objects for the connected database.
+    """
+    
+    # Check for db directory. If it does not exist, create it.
+    if "db" not in os.listdir():
+        os.mkdir(path=os.getcwd() + os.sep + "db")
+        print("Directory 'db' was not found and was created locally")
+
+    # Connect by path rather than changing the cwd to db, since the cwd is shared by every thread (e.g. the chat bot loading its model)
+    con = sqlite3.connect(database=os.path.join("db", "Message.db"))    # Estabish a connection w/ database
+    cur = con.cursor()                                                  # Create a Cursor
+    print("Connected to Message.db")
+    
+    for pragma in DB_PRAGMAS:
+        cur.execute(pragma)
+    # Create the Message table, or upgrade it if it was made by an older version
+    migrateDB(con, cur)
     return (con, cur)
 
 
 def getMostRecent(con : sqlite3.Connection, cur : sqlite3.Cursor, channelid : int) -> int | None:
     """Returns the most recently sent messageid with a matching channelid in connected database,
-    or None if no messages were found in that channel. (Recency is determined by the datetime in the "sent" column)
+    or None if no messages were found in that channel. (Recency is determined by the time in the "sent_ms" column)
     
     Args:
         `con` : Connection to database
@@ -129,7 +297,8 @@ def getMostRecent(con : sqlite3.Connection, cur : sqlite3.Cursor, channelid : in
         result = cur.execute("SELECT messageid " +
                             "FROM Message " +
                             "WHERE channelid = ? " +
-                            "ORDER BY sent DESC;",
+                            "ORDER BY sent_ms DESC " +
+                            "LIMIT 1;",
                             (channelid,))
         return result.fetchone()[0]
     except:
@@ -138,8 +307,177 @@ def getMostRecent(con : sqlite3.Connection, cur : sqlite3.Cursor, channelid : in
         return None
 
 
+def getScrapeCursor(con : sqlite3.Connection, cur : sqlite3.Cursor, channelid : int) -> int | None:
+    """Returns the ID of the newest message saved from a channel by the scraper, or None if it hasn't been scraped yet
+
+    Args:
+        `con` : Connection to database
+        `cur` : Cursor for connected database
+        `channelid` : ID of the channel
+    """
+    result = cur.execute("SELECT lastmessageid FROM ScrapeCursor WHERE channelid = ?;", (channelid,)).fetchone()
+    return result[0] if result else None
+
+
+def advanceScrapeCursors(cur : sqlite3.Cursor, lastMessageIDs : dict[int, int]):
+    """Moves the scrape cursors of channels forward to the given message IDs ({channelid: messageid}). Cursors never move backward.
+    Doesn't commit, so it can be committed together with the messages it covers.
+
+    Args:
+        `cur` : Cursor for connected database
+        `lastMessageIDs` : ID of the newest saved message in each channel
+    """
+    cur.executemany("INSERT INTO ScrapeCursor (channelid, lastmessageid) VALUES (?, ?) " +
+                    "ON CONFLICT (channelid) DO UPDATE SET lastmessageid = MAX(lastmessageid, excluded.lastmessageid);",
+                    list(lastMessageIDs.items()))
+
+
+class MsgCleaner:
+    """Cleans message contents by removing embedded links/emojis, replacing IDs with names, etc.
+    All regexes are compiled once when the cleaner is made, and every mention in a message is resolved in a single pass,
+    so build one cleaner and reuse it for every message. Output is the same as the old per-mention cleanMsg().
+
+    Args:
+        `names` : dict of id/name pairs from names.json
+        `config` : config dict from config.json
+    """
+    # Bump this whenever a change to the cleaner would change its output, so cleanAllData() re-cleans all stored messages.
+    version = 1
+    
+    linkRegex = re.compile(r"http\S+|www\S+|https\S+")
+    emojiRegex = re.compile(r"\<.+?:\d+\>")
+    mentionRegex = re.compile(r"\<[#@].*?(\d+?)\>")
+    # Matches only well-formed mentions (<@id>, <@!id>, <@&id>, <#id>). When every "<@"/"<#" in a message starts one of these,
+    # it finds exactly the same mentions as mentionRegex, but much faster.
+    simpleMentionRegex = re.compile(r"<(?:@[!&]?|#)(\d+)>")
+    whitespaceRegex = re.compile(r"[^\S\n]+")     # all whitespace except newlines
+
+    def __init__(self, names : dict[str, str], config : dict[str, (str | int | list[int])]) -> None:
+        self.names = names
+        self.config = config
+        self.botID = str(config["botID"])
+        self.impersonateID = str(config["userToImpersonateID"])
+        self.personas = config.get("personas", {})
+        # Names that can't form part of a new mention or regex escape once substituted into a message.
+        # If any name can, mentions are always replaced one ID at a time like the old cleaner did.
+        self.namesAreSimple = all(not any(char in name for char in "\\<>")
+                                  and not name.startswith(("@", "#"))
+                                  and not name[-1:].isdigit()
+                                  for name in names.values())
+
+    def replaceMentions(self, msgContent : str) -> str:
+        """Replaces every @ mention & channel mention in a message with the name specified in names.json,
+        or entirely deletes the mention if it has no name.
+        """
+        mentions : list[re.Match] = []
+        def replace(match : re.Match) -> str:
+            mentions.append(match)
+            return self.names.get(match.group(1), "")
+        mentionStarts = msgContent.count("<@") + msgContent.count("<#")
+        if mentionStarts == 0:
+            return msgContent
+        cleaned = self.simpleMentionRegex.sub(replace, msgContent)
+        if len(mentions) != mentionStarts:     # some mention isn't well-formed, so redo this with the full regex
+            mentions.clear()
+            cleaned = self.mentionRegex.sub(replace, msgContent)
+        if not mentions:
+            return msgContent
+        
+        # The old cleaner replaced one ID at a time, and its per-ID regex could swallow everything between the start of one mention and
+        # a later "<id>>" (e.g. a second mention of the same ID). Those rare messages go through the old algorithm so the output stays the same.
+        ids = [match.group(1) for match in mentions]
+        if not self.namesAreSimple or self.mentionsOverlap(msgContent, mentions, ids):
+            for id in ids:
+                msgContent = re.sub(r"\<[#@].*?" + id + r"\>", self.names.get(id, ""), msgContent)
+            return msgContent
+        return cleaned
+
+    def mentionsOverlap(self, msgContent : str, mentions : list[re.Match], ids : list[str]) -> bool:
+        """Returns True if replacing the given mentions one ID at a time could give a different result than replacing them all at once.
+        The old per-ID regex matched from the first "<@"/"<#" on a line to the next "<id>>", so that can only happen when an ID ends with
+        another mentioned ID, "<id>>" also appears outside of a mention of that ID, or a mention of an ID follows an earlier one
+        with some other "<@"/"<#" before it on its line.
+        """
+        if len(set(map(len, ids))) > 1 and any(id != other and id.endswith(other) for id in ids for other in ids):
+            return True
+        lastEnds : dict[str, int] = {}  # id -> where its latest mention ended
+        for (match, id) in zip(mentions, ids):
+            if id in lastEnds:
+                lineStart = max(lastEnds[id], msgContent.rfind("\n", 0, match.start()) + 1)
+                between = msgContent[lineStart:match.start()]
+                if "<@" in between or "<#" in between:
+                    return True
+            lastEnds[id] = match.end()
+        return any(msgContent.count(id + ">") != ids.count(id) for id in lastEnds)
+
+    def clean(self, msgContent : str, sentBy : str, isTrainingData = False) -> str:
+        """Returns cleaned message content as a string
+
+        Args:
+            `msgContent` : Content of message to clean
+            `sentBy` : string of ID of user who sent this message
+            `isTrainingData` = `False` : If set to True, messages starting with "/kc" and messages sent by the bot will return an empty string
+        """
+        # If this is training data, immediately delete all content if the message was sent by KCBot or starts with "/kc"
+        if isTrainingData:
+            if msgContent.startswith("/kc") or str(sentBy) == self.botID:
+                return ""
+        # If this is not training data, delete "/kc" from the start of messages and change mentions of the botID to the userID they are attempting to mimic.
+        # This WILL result in the bot believing it is that user. Messages sent by the real user are treated by the bot as if it sent those messages.
+        else:
+            msgContent = msgContent.replace(self.botID, self.impersonateID)
+            if msgContent.startswith("/kc "):
+                persona = getPersonaCommand(msgContent, self.personas)
+                msgContent = msgContent[4:].strip()
+                if persona is not None:     # "/kc <persona>" only picks who responds, so it isn't part of the message
+                    msgContent = msgContent[len(persona):].strip()
+        
+        # Removing embedded links & images (skipped when the message can't contain one)
+        if "http" in msgContent or "www" in msgContent:
+            msgContent = self.linkRegex.sub("", msgContent)
+        if "<" in msgContent:
+            # Removing discord emoji. Unicode emojis are left unchanged.
+            if ":" in msgContent:
+                msgContent = self.emojiRegex.sub("", msgContent)
+            # Replacing @ mentions & channel mentions with names specified in names.json
+            msgContent = self.replaceMentions(msgContent)
+        
+        # Cleaning up extra whitespace (keeping newlines). Skipped for plain ASCII text that has nothing to clean up.
+        if not msgContent.isascii() or "  " in msgContent or any(char in msgContent for char in "\t\r\x0b\x0c\x1c\x1d\x1e\x1f"):
+            msgContent = self.whitespaceRegex.sub(" ", msgContent)
+        # Strip trailing & leading whitespace (including newlines)
+        return msgContent.strip()
+
+    def clean_many(self, rows : Iterable[tuple[str, str]], isTrainingData = True) -> list[str]:
+        """Cleans a batch of messages. Returns a list of cleaned message contents, in the same order as `rows`.
+
+        Args:
+            `rows` : iterable of (msgContent, sentBy) pairs
+            `isTrainingData` = `True` : passed on to clean() for every message
+        """
+        clean = self.clean
+        return [clean(msgContent, sentBy, isTrainingData) for (msgContent, sentBy) in rows]
+
+
+# The most recently built cleaner, reused by cleanMsg() as long as it is called with the same names & config dicts
+lastCleaner : MsgCleaner = None
+
+def getCleaner(names : dict[str, str], config : dict[str, (str | int | list[int])]) -> MsgCleaner:
+    """Returns a MsgCleaner for the given names & config, only building a new one if they are different dicts from last time.
+    
+    Args:
+        `names` : dict of id/name pairs from names.json
+        `config` : config dict from config.json
+    """
+    global lastCleaner
+    if lastCleaner is None or lastCleaner.names is not names or lastCleaner.config is not config:
+        lastCleaner = MsgCleaner(names, config)
+    return lastCleaner
+
+
 def cleanMsg(msgContent : str, sentBy : str, names : dict[str, str], config : dict[str, (str | int | list[int])], isTrainingData = False) -> str:
     """Handles cleaning a message's contents by removing embedded links/emojis, replacing IDs with names, etc.
+    For cleaning many messages, prefer building a MsgCleaner once and calling its clean()/clean_many() methods.
     
     Returns cleaned message content as a string
 
@@ -150,36 +488,7 @@ def cleanMsg(msgContent : str, sentBy : str, names : dict[str, str], config : di
         `config` : config dict from config.json
         `isTrainingData` = `False` : If set to True, messages starting with "/kc" and messages sent by the bot will return an empty string
     """
-    
-    # If this is training data, immediately delete all content if the message was sent by KCBot or starts with "/kc"
-    if isTrainingData and (re.match(r"/kc", msgContent) != None or str(sentBy) == str(config["botID"])):
-        return ""
-    # If this is not training data, delete "/kc" from the start of messages and change mentions of the botID to the userID they are attempting to mimic.
-    # This WILL result in the bot believing it is that user. Messages sent by the real user are treated by the bot as if it sent those messages.
-    elif not isTrainingData:
-        msgContent = re.sub(str(config["botID"]), str(config["userToImpersonateID"]), msgContent)
-        if re.match(r"/kc ", msgContent) != None:
-            msgContent = msgContent[4:].strip()
-    
-    # Removing embedded links & images
-    msgContent = re.sub(r"http\S+|www\S+|https\S+", "", msgContent)
-    # Removing discord emoji. Unicode emojis are left unchanged.
-    msgContent = re.sub(r"\<.+?:\d+\>", "", msgContent)
-    
-    # Replacing @ mentions & channel mentions with names specified in names.json
-    mentions = re.findall(r"\<[#@].*?(\d+?)\>", msgContent)
-    for id in mentions:
-        if id in names: # If this user or channel mention has a specified name, replace it with the name
-            msgContent = re.sub(r"\<[#@].*?" + id + r"\>", names[id], msgContent)
-        else:           # Otherwise, entirely delete the mention
-            msgContent = re.sub(r"\<[#@].*?" + id + r"\>", "", msgContent)
-            
-    # Cleaning up extra whitespace (keeping newlines)
-    msgContent = re.sub(r"(?:(?!\n)\s)+", " ", msgContent)
-    # Strip trailing & leading whitespace (including newlines)
-    msgContent = msgContent.strip()
-    
-    return msgContent
+    return getCleaner(names, config).clean(msgContent, sentBy, isTrainingData)
 
 
 def formatMsg(msgContent : str, sentBy : str, names : dict[str, str], config : dict[str, (str | int | list[int])], isTrainingData = False) -> str:
@@ -208,59 +517,792 @@ def formatMsg(msgContent : str, sentBy : str, names : dict[str, str], config : d
         return f"{names[str(sentBy)]}: {msgContent}"
 
 
-def generateTrainingData(con : sqlite3.Connection, cur : sqlite3.Cursor) -> list[dict[str, str]]:
-    """Creates and returns a list of prompt/input/output dicts to be used as training data.
+class ConversationSegmenter:
+    """Assigns messages to conversations, one channel at a time.
+    Messages are in the same conversation if they are in the same channel and are sent less than 8 hours apart (or are replying to a message).
+    Feed it every message in a channel with assign(), in the order they were sent (including messages already in a conversation, so
+    it can follow along), then call startChannel() before moving on to the next channel.
+
+    Args:
+        `lastConversID` : The highest conversid already used in db. New conversations are numbered from here.
+        `findConversID` = `None` : Function that looks up the conversid of a message that was not fed to this segmenter (or None if unknown).
+        Used for replies to messages from outside the channel or outside of what was fed in.
+    """
+    gapMs = 8 * 60 * 60 * 1000  # Messages sent more than 8 hours after the last message from another user start a new conversation
+
+    def __init__(self, lastConversID : int, findConversID = None) -> None:
+        self.lastConversID = lastConversID
+        self.findConversID = findConversID
+        self.startChannel()
+
+    def startChannel(self):
+        """Forgets everything about the current channel, so the segmenter is ready for the first message of another one."""
+        self.conversIDs : dict[int, int] = {}   # messageid -> conversid of every message seen in this channel (used for replies)
+        self.prevUserID : int = None            # userid of the previous message
+        self.prevSentMs : int = None            # send time of the previous message
+        self.prevOtherSentMs : int = None       # send time of the previous message sent by a different user
+        self.prevConversID : int = None         # conversid of the previous message
+
+    def newConversID(self) -> int:
+        self.lastConversID += 1
+        return self.lastConversID
+
+    def assign(self, messageid : int, userid : int, sentMs : int, replyid : int | None, conversid : int = -1) -> tuple[int, int] | None:
+        """Works out which conversation a message belongs to.
+        Returns a tuple of (conversid, isFirstInConvers) for the message, or None if it was already in a conversation.
+
+        Args:
+            `messageid` : ID of the message
+            `userid` : ID of the user who sent the message
+            `sentMs` : When the message was sent, in ms since the Unix epoch (the "sent_ms" column)
+            `replyid` : ID of the message this message replies to, or None
+            `conversid` = `-1` : conversid the message already has in db. -1 means it has not been assigned to a conversation yet.
+        """
+        result = None
+        # If this message has already been assigned to a conversation, just keep track of it.
+        if conversid != -1:
+            self.prevOtherSentMs = sentMs
+        # If this is the first message in this channel, make a new conversID for it.
+        elif self.prevUserID is None:
+            conversid = self.newConversID()
+            self.prevOtherSentMs = sentMs
+            result = (conversid, 1)
+        else:
+            # If the previous message is sent by a different user than the current message, it is now the previous message from another user.
+            if userid != self.prevUserID:
+                self.prevOtherSentMs = self.prevSentMs
+            # If it is a reply message, add it to the same conversation as the message it replied to.
+            # If we don't know that message (e.g. it was sent before our scraped history starts), treat this as a normal message.
+            if replyid is not None:
+                conversid = self.conversIDs.get(replyid)
+                if conversid is None and self.findConversID is not None:
+                    conversid = self.findConversID(replyid)
+                if conversid == -1:
+                    conversid = None
+            if conversid is not None and conversid != -1:
+                result = (conversid, 0)
+            # If the last message from another user was more than 8 hours ago, make a new conversation ID for it.
+            elif self.prevOtherSentMs < sentMs - self.gapMs:
+                conversid = self.newConversID()
+                self.prevOtherSentMs = sentMs
+                result = (conversid, 1)
+            # Otherwise, add it to the same conversation as the previous message.
+            else:
+                conversid = self.prevConversID
+                result = (conversid, 0)
+        self.conversIDs[messageid] = conversid
+        self.prevUserID = userid
+        self.prevSentMs = sentMs
+        self.prevConversID = conversid
+        return result
+
+
+def getPrompt(names : dict[str, str], config : dict[str, (str | int | list[int])]) -> str:
+    """Returns the instruction prompt given to the AI, both in training data and when chatting.
+    
+    Args:
+        `names` : dict of id/name pairs from names.json
+        `config` : config dict from config.json
+    """
+    name = names[str(config["userToImpersonateID"])]
+    return f"You are {name} in a chat room with some friends. You chat unfiltered, and saying rude things, cracking jokes, and swearing are encouraged."
+
+
+# ----- Token counting & chat history -----
+
+TOKENIZER_NAME = "facebook/opt-350m"    # the tokenizer of the model being trained & chatted with
+DEFAULT_CONTEXT_TOKENS = 256            # default for "contextTokenBudget" in config.json
+msgTokenizer = None
+# Held while encoding with a tokenizer that other threads use too. Fast tokenizers change their padding settings in place when they are
+# called with different ones, which fails ("Already borrowed") if another thread is encoding with it at the same time.
+tokenizerLock = threading.Lock()
+
+def setMsgTokenizer(tokenizer):
+    """Makes countTokens() use an already loaded tokenizer of TOKENIZER_NAME (e.g. the chat bot's), instead of loading its own.
+    Other threads that encode with it should hold tokenizerLock while they do.
+    """
+    global msgTokenizer
+    msgTokenizer = tokenizer
+
+def countTokens(texts : list[str]) -> list[int]:
+    """Returns how many tokens each text is, without special tokens. transformers is only imported (and the tokenizer loaded) the first time."""
+    global msgTokenizer
+    if msgTokenizer is None:
+        import transformers
+        msgTokenizer = transformers.AutoTokenizer.from_pretrained(TOKENIZER_NAME)
+    with tokenizerLock:
+        return [len(ids) for ids in msgTokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+
+def countMsgTokens(contents : list[str]) -> list[int]:
+    """Returns how many tokens the content of each message takes up in a formatted message ("Name: content"), i.e. with the space before it.
+    This is what the tokencount column holds. Empty messages are left out of the chat history, so they count as 0.
+    """
+    counts = countTokens([" " + content for content in contents])
+    return [count if content != "" else 0 for (content, count) in zip(contents, counts)]
+
+
+def updateTokenCounts(con : sqlite3.Connection, cur : sqlite3.Cursor, chunkSize = 5000):
+    """Counts the tokens of every message in db that hasn't been counted since its content last changed, in chunks that are each committed.
+
+    Args:
+        `con` : Connection to database
+        `cur` : Cursor for connected database
+        `chunkSize` = `5000` : Number of messages to count & update per transaction
+    """
+    totalCount = 0
+    while True:
+        rows = cur.execute("SELECT messageid, content FROM Message WHERE tokencount IS NULL LIMIT ?;", (chunkSize,)).fetchall()
+        if not rows:
+            break
+        counts = countMsgTokens([content for (_, content) in rows])
+        try:    # try updating this chunk, then commit
+            cur.executemany("UPDATE Message SET tokencount = ? WHERE messageid = ?;", [(count, messageid) for ((messageid, _), count) in zip(rows, counts)])
+            con.commit()
+        except: # rollback if this fails
+            print("WARNING - Failed to write to database")
+            con.rollback()
+            raise
+        totalCount += len(rows)
+    if totalCount:
+        print(f"Counted the tokens of {totalCount} messages in Message.db")
+
+
+class ContextWindow:
+    """The most recent messages of a chat that fit in a token budget, used as the chat history (the "### Input:") given to the model.
+    Training data and the chat bot both build their history with this, so the model sees the same amount of history in both.
+    Messages are added newest last, and the oldest ones are dropped once the total goes over the budget (the newest message is always kept).
+    Empty messages are kept as "" with a cost of 0, so they can still be edited/removed by key, but they are left out of the history text.
+
+    Args:
+        `budget` : Most tokens the chat history may take up
+    """
+    def __init__(self, budget : int) -> None:
+        self.budget = budget
+        self.messages : deque[tuple[int | None, str, int]] = deque()   # (key, formatted message or "", token cost) of each message, oldest first
+        self.tokens = 0
+
+    def clear(self):
+        self.messages.clear()
+        self.tokens = 0
+
+    def append(self, formattedMsg : str, cost : int, key : int = None):
+        """Adds the newest message, with its token cost (see msgCost()). `key` (e.g. the messageid) is only needed for replace() & remove()."""
+        self.messages.append((key, formattedMsg, cost))
+        self.tokens += cost
+        self.trim()
+
+    def trim(self):
+        while self.tokens > self.budget and len(self.messages) > 1:
+            self.tokens -= self.messages.popleft()[2]
+
+    def replace(self, key : int, formattedMsg : str, cost : int):
+        """Changes the message with the given key (e.g. after an edit). Does nothing if it is not in the window."""
+        for (index, (messageKey, _, oldCost)) in enumerate(self.messages):
+            if messageKey == key:
+                self.messages[index] = (key, formattedMsg, cost)
+                self.tokens += cost - oldCost
+                self.trim()
+                return
+
+    def remove(self, key : int):
+        """Removes the message with the given key (e.g. after it is deleted). Does nothing if it is not in the window."""
+        for entry in self.messages:
+            if entry[0] == key:
+                self.messages.remove(entry)
+                self.tokens -= entry[2]
+                return
+
+    def keys(self) -> list[int | None]:
+        return [key for (key, _, _) in self.messages]
+
+    def hasText(self) -> bool:
+        return any(formattedMsg != "" for (_, formattedMsg, _) in self.messages)
+
+    def text(self) -> str:
+        """Returns the non-empty messages joined into a single chat history string"""
+        return "\n".join(formattedMsg for (_, formattedMsg, _) in self.messages if formattedMsg != "")
+
+
+class MsgCostCounter:
+    """Works out the token cost of formatted messages for a ContextWindow: the "Name:" before the content, the content itself
+    (usually the cached tokencount from db) and the newline between messages. The cost of each "Name:" is counted once and remembered.
+    """
+    def __init__(self) -> None:
+        self.prefixTokens : dict[str, int] = {}
+        self.newlineTokens = None
+
+    def cost(self, formattedMsg : str, content : str, contentTokens : int = None) -> int:
+        """Returns the token cost of a formatted message ("" costs 0)
+
+        Args:
+            `formattedMsg` : The message formatted by formatMsg()
+            `content` : The message's content
+            `contentTokens` = `None` : The cached tokencount of the content. Counted now if not given.
+        """
+        if formattedMsg == "":
+            return 0
+        if contentTokens is None:
+            contentTokens = countMsgTokens([content])[0]
+        prefix = formattedMsg[:len(formattedMsg) - len(content) - 1]   # "Name:"
+        if prefix not in self.prefixTokens:
+            (self.prefixTokens[prefix], self.newlineTokens) = countTokens([prefix, "\n"])
+        return self.prefixTokens[prefix] + contentTokens + self.newlineTokens
+
+
+def iterPersonaTrainingData(con : sqlite3.Connection, cur : sqlite3.Cursor, userIDs : list[int], limit : int = None, since : int = None,
+                            names : dict[str, str] = None, config : dict[str, (str | int | list[int])] = None,
+                            tokenBudget : int = None) -> Iterator[tuple[int, dict[str, str]]]:
+    """Yields (userID, example) pairs of training data for several personas at once, from a single read of the database.
+    Each example is a prompt/input/output dict that also holds the conversid it came from, and the userID is the persona it trains
+    (the user who sent its output). The chat history is built the same way no matter who is impersonated, so one scan serves every persona.
+    The chat history of each example is the most recent messages of its conversation that fit in the token budget (see ContextWindow),
+    using the token counts cached in db (any that are missing are counted first).
+    The whole Message table is read once, in (conversid, sent_ms) order, and only the chat history of the current
+    conversation is held in memory, so memory use does not grow with the size of the database.
     
     Args:
         `con` : Connection to database
         `cur` : Cursor for connected database
+        `userIDs` : IDs of the users to make training data for (e.g. from getPersonaIDs())
+        `limit` = `None` : If given, stop after yielding this many examples in total (useful for quick partial builds)
+        `since` = `None` : If given (ms since the Unix epoch), only yield examples whose output was sent at or after this time.
+         Older messages are still used as chat history.
+        `names` = `None` : dict of id/name pairs. Loaded from names.json if not given.
+        `config` = `None` : config dict. Loaded from config.json if not given.
+        `tokenBudget` = `None` : Most tokens the chat history of an example may take up. Defaults to "contextTokenBudget" in config.json.
     """
-    print("Creating training data dict with prompt/input/outputs")
-    trainingOutput = []
+    print(f"Creating training data with prompt/input/outputs for {len(userIDs)} persona(s)")
     
     # Load both json files
-    names = getNames()
-    config = getConfig()
+    if names is None:
+        names = getNames()
+    if config is None:
+        config = getConfig()
+    if tokenBudget is None:
+        tokenBudget = config.get("contextTokenBudget", DEFAULT_CONTEXT_TOKENS)
+    prompts = {userID: getPrompt(names, personaConfig(config, userID)) for userID in userIDs}
+    
+    updateTokenCounts(con, cur)
+    if since is None:
+        cur.execute("SELECT conversid, userid, content, isFirstInConvers, sent_ms, tokencount FROM Message ORDER BY conversid ASC, sent_ms ASC;")
+    else:
+        # Every conversation with a message sent since then has a conversid at least as big as the smallest one among those messages
+        cur.execute("SELECT conversid, userid, content, isFirstInConvers, sent_ms, tokencount FROM Message " +
+                    "WHERE conversid >= (SELECT MIN(conversid) FROM Message WHERE sent_ms >= ?) " +
+                    "ORDER BY conversid ASC, sent_ms ASC;",
+                    (since,))
+    
+    exampleCounts = {userID: 0 for userID in userIDs}
+    exampleCount = 0
+    conversCount = 0
+    currentConversID = None
+    # The most recent messages in this conversation that fit in the budget, already formatted
+    recentMsgHistory = ContextWindow(tokenBudget)
+    costs = MsgCostCounter()
+    for (conversID, msgUserID, content, isFirstInConvers, sentMs, tokenCount) in cur:
+        if conversID != currentConversID:
+            currentConversID = conversID
+            recentMsgHistory.clear()
+            conversCount += 1
         
-    # get a list of all get all conversations to iterate through.
-    cur.execute("SELECT DISTINCT conversID FROM Message;")
-    allConversIDs = cur.fetchall()
+        # skip this message if content is empty, or this is the first message in conversation, or it is not sent by an impersonated user.
+        # also skip it if no previous message in conversation contained text, or it is older than `since`.
+        if (content != "" and isFirstInConvers != 1 and msgUserID in prompts
+                and recentMsgHistory.hasText() and (since is None or sentMs >= since)):
+            # combine the non-empty formatted messages into a single chat history string
+            chatHistory = recentMsgHistory.text()
+            yield (msgUserID, {
+                "instruction": prompts[msgUserID],
+                "input": chatHistory,
+                "output": content,
+                "conversid": conversID,
+            })
+            exampleCounts[msgUserID] += 1
+            exampleCount += 1
+            if limit is not None and exampleCount >= limit:
+                break
+        
+        # Don't add empty messages to training data (these are usually images)
+        formattedMsg = formatMsg(content, msgUserID, names, config, True) if content != "" else ""
+        recentMsgHistory.append(formattedMsg, costs.cost(formattedMsg, content, tokenCount))
+    print(f"{exampleCount} sets of training data created from {conversCount} conversations" +
+          (f" ({', '.join(f'{names.get(str(userID), userID)}: {count}' for (userID, count) in exampleCounts.items())})" if len(userIDs) > 1 else ""))
+
+
+def iterTrainingData(con : sqlite3.Connection, cur : sqlite3.Cursor, limit : int = None, since : int = None,
+                     names : dict[str, str] = None, config : dict[str, (str | int | list[int])] = None, tokenBudget : int = None) -> Iterator[dict[str, str]]:
+    """Yields prompt/input/output dicts to be used as training data for userToImpersonateID, one at a time.
+    Each also holds the conversid it came from. See iterPersonaTrainingData() for how they are made, and for the arguments.
+    """
+    if config is None:
+        config = getConfig()
+    for (_, example) in iterPersonaTrainingData(con, cur, [config["userToImpersonateID"]], limit, since, names, config, tokenBudget):
+        yield example
+
+
+def writePersonaTrainingData(examples : Iterable[tuple[int, dict[str, str]]], paths : dict[int, str], chunkSize = 1000) -> dict[int, int]:
+    """Writes training data for several personas to one JSON Lines file each (one example per line) as it is generated,
+    `chunkSize` examples per file at a time.
+    
+    Returns the number of examples written to each file, by userID.
+
+    Args:
+        `examples` : (userID, example) pairs, e.g. from iterPersonaTrainingData()
+        `paths` : Path of the .jsonl file to write for each userID
+        `chunkSize` = `1000` : Number of examples to buffer for each file before writing them
+    """
+    counts = {userID: 0 for userID in paths}
+    chunks = {userID: [] for userID in paths}
+    files = {}
+    try:
+        for (userID, path) in paths.items():
+            files[userID] = open(path, 'w')
+        for (userID, example) in examples:
+            chunk = chunks[userID]
+            chunk.append(json.dumps(example))
+            counts[userID] += 1
+            if len(chunk) >= chunkSize:
+                files[userID].write("\n".join(chunk) + "\n")
+                chunk.clear()
+        for (userID, chunk) in chunks.items():
+            if chunk:
+                files[userID].write("\n".join(chunk) + "\n")
+    finally:
+        for f in files.values():
+            f.close()
+    return counts
+
+
+def writeTrainingData(examples : Iterable[dict[str, str]], path : str, chunkSize = 1000) -> int:
+    """Writes training data to a JSON Lines file (one example per line) as it is generated, `chunkSize` examples at a time.
+    
+    Returns the number of examples written.
+
+    Args:
+        `examples` : Training data dicts, e.g. from iterTrainingData()
+        `path` : Path of the .jsonl file to write
+        `chunkSize` = `1000` : Number of examples to buffer before each write
+    """
+    return writePersonaTrainingData(((None, example) for example in examples), {None: path}, chunkSize)[None]
+
+
+def generateTrainingData(con : sqlite3.Connection, cur : sqlite3.Cursor, names : dict[str, str] = None, config : dict[str, (str | int | list[int])] = None) -> list[dict[str, str]]:
+    """Creates and returns a list of prompt/input/output dicts to be used as training data.
+    This holds the whole dataset in memory; use iterTrainingData() & writeTrainingData() for big databases.
     
-    name = getNames()[str(getConfig()["userToImpersonateID"])]
-    prompt = f"You are {name} in a chat room with some friends. You chat unfiltered, and saying rude things, cracking jokes, and swearing are encouraged."
-
-    for (conversID,) in allConversIDs:
-        # fetch the entire conversation from db
-        cur.execute("SELECT * FROM Message WHERE conversid = ? ORDER BY sent ASC;", (conversID,))
-        # remember this convers as an iterable datatype (list of Message objects)
-        convers = []
-        for row in cur:
-            convers.append(Message(row))
-        # iterate over messages in this convers
-        for index in range(len(convers)):
-            msg : Message = convers[index]
-            # skip this message if content is empty, or this is the first message in conversation, or it is not sent by the impersonated user.
-            if msg.content == "" or msg.isFirstInConvers == 1 or msg.userid != config["userToImpersonateID"]:
+    Args:
+        `con` : Connection to database
+        `cur` : Cursor for connected database
+        `names` = `None` : dict of id/name pairs. Loaded from names.json if not given.
+        `config` = `None` : config dict. Loaded from config.json if not given.
+    """
+    return list(iterTrainingData(con, cur, names=names, config=config))
+
+
+class ExampleDeduplicator:
+    """Drops near-duplicate and low-value training examples as they stream past, so they don't cost training time.
+    Texts are compared by MinHash signatures of their shingles (word 3-grams of the input, character 5-grams of the output),
+    and only examples that share an LSH bucket with a kept example are compared at all, so this scales to millions of examples.
+    Examples whose output can be a repeat are looked up by their output, and all others (only droppable as duplicates) by their input.
+    An example is dropped (first one wins) if:
+        "duplicate" : its input and output are both near-duplicates of an example that was kept (copy-pasted chats)
+        "repeated output" : its output is a near-duplicate of `maxOutputRepeats` kept outputs (memes, spam like "badger")
+        "echo" : its output is a near-duplicate of one of the last 3 messages in its own input (repeating what was just said)
+    Short outputs (like "lol") are naturally common, so they are only ever dropped as part of a duplicate.
+    Needs numpy (installed with the training packages). Results are the same on every run.
+
+    Args:
+        `inputThreshold` = `0.8` : How similar (estimated Jaccard similarity, 0-1) two inputs must be to count as near-duplicates
+        `outputThreshold` = `0.8` : How similar two outputs (or an output and an input message) must be to count as near-duplicates
+        `maxOutputRepeats` = `3` : How many examples may have (nearly) the same output. 0 turns the "repeated output" check off.
+        `minChars` = `20` : Outputs shorter than this are never dropped as a repeated output or an echo
+        `numPerm` = `64` : Length of the MinHash signatures. Longer ones estimate similarity more precisely but take longer.
+    """
+    def __init__(self, inputThreshold = 0.8, outputThreshold = 0.8, maxOutputRepeats = 3, minChars = 20, numPerm = 64) -> None:
+        import numpy as np
+        self.np = np
+        self.inputThreshold = inputThreshold
+        self.outputThreshold = outputThreshold
+        self.maxOutputRepeats = maxOutputRepeats
+        self.minChars = minChars
+        # Random hash functions h(x) = (a*x + b) mod p, from a fixed seed so the same examples are always dropped
+        rng = np.random.default_rng(1)
+        self.mersennePrime = np.uint64((1 << 61) - 1)
+        self.a = rng.integers(1, self.mersennePrime, size=(numPerm, 1), dtype=np.uint64)
+        self.b = rng.integers(0, self.mersennePrime, size=(numPerm, 1), dtype=np.uint64)
+        # LSH buckets of output signatures (only long outputs, which are the only ones that can be repeats) and of input signatures
+        (self.bands, self.rows) = self.bandShape(numPerm, outputThreshold)
+        (self.inputBands, self.inputRows) = self.bandShape(numPerm, inputThreshold)
+        self.buckets : list[dict[bytes, list[int]]] = [{} for _ in range(self.bands)]
+        self.inputBuckets : list[dict[bytes, list[int]]] = [{} for _ in range(self.inputBands)]
+        self.inputSigs = []     # signatures of each kept example
+        self.outputSigs = []
+        self.total = 0
+        self.dropped = {"duplicate": 0, "repeated output": 0, "echo": 0}
+        self.droppedOutputs : dict[str, int] = {}   # normalized output -> times it was dropped
+
+    @staticmethod
+    def bandShape(numPerm : int, threshold : float) -> tuple[int, int]:
+        """Returns the (bands, rows) split of a signature whose collision threshold (1/bands)^(1/rows) is closest to, but not over, `threshold`"""
+        options = [(numPerm // rows, rows) for rows in range(1, numPerm + 1) if numPerm % rows == 0]
+        below = [option for option in options if (1 / option[0]) ** (1 / option[1]) <= threshold] or options[:1]
+        return max(below, key=lambda option: (1 / option[0]) ** (1 / option[1]))
+
+    whitespaceRegex = re.compile(r"\s+")
+
+    def normalize(self, text : str) -> str:
+        return self.whitespaceRegex.sub(" ", text.lower()).strip()
+
+    def wordShingles(self, text : str) -> set[str]:
+        words = text.split(" ")
+        if len(words) < 3:
+            return {text}
+        return {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+    def charShingles(self, text : str) -> set[str]:
+        if len(text) < 5:
+            return {text}
+        return {text[i:i + 5] for i in range(len(text) - 4)}
+
+    def signature(self, shingles : set[str]):
+        """Returns the MinHash signature (numPerm uint32s) of a set of shingles"""
+        np = self.np
+        hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+        # a * hashes wraps around at 2^64, which still gives usable permutations
+        return (((self.a * hashes + self.b) % self.mersennePrime) & np.uint64(0xFFFFFFFF)).min(axis=1).astype(np.uint32)
+
+    def similarity(self, sigA, sigB) -> float:
+        """Estimated Jaccard similarity of the shingles behind two signatures"""
+        return float((sigA == sigB).mean())
+
+    def check(self, example : dict[str, str]) -> str | None:
+        """Returns why an example should be dropped, or None (and indexes it) if it should be kept"""
+        output = self.normalize(example["output"])
+        outputShingles = self.charShingles(output)
+        isLong = len(output) >= self.minChars
+        # Echoes are checked exactly, since there are only a few messages to compare with
+        for line in (example["input"].split("\n")[-3:] if isLong else []):
+            lineShingles = self.charShingles(self.normalize(line.split(": ", 1)[-1]))
+            if len(outputShingles & lineShingles) >= self.outputThreshold * len(outputShingles | lineShingles):
+                return "echo"
+        
+        outputSig = self.signature(outputShingles)
+        inputSig = self.signature(self.wordShingles(self.normalize(example["input"])))
+        bandKeys = [outputSig[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+        inputBandKeys = [inputSig[band * self.inputRows:(band + 1) * self.inputRows].tobytes() for band in range(self.inputBands)]
+        checkRepeats = isLong and self.maxOutputRepeats > 0
+        # Without the repeat check, only duplicates (which also need a similar input) can be dropped, so candidates come from the input buckets.
+        # Otherwise common short replies like "lol" would all pile into the same output buckets, and each one would be compared with every earlier copy.
+        candidates = set()
+        for (bucket, key) in (zip(self.buckets, bandKeys) if checkRepeats else zip(self.inputBuckets, inputBandKeys)):
+            candidates.update(bucket.get(key, ()))
+        outputRepeats = 0
+        for candidate in candidates:
+            if self.similarity(outputSig, self.outputSigs[candidate]) >= self.outputThreshold:
+                if self.similarity(inputSig, self.inputSigs[candidate]) >= self.inputThreshold:
+                    return "duplicate"
+                outputRepeats += 1
+        if checkRepeats and outputRepeats >= self.maxOutputRepeats:
+            return "repeated output"
+        
+        index = len(self.outputSigs)
+        self.outputSigs.append(outputSig)
+        self.inputSigs.append(inputSig)
+        if isLong:
+            for (bucket, key) in zip(self.buckets, bandKeys):
+                bucket.setdefault(key, []).append(index)
+        for (bucket, key) in zip(self.inputBuckets, inputBandKeys):
+            bucket.setdefault(key, []).append(index)
+        return None
+
+    def keep(self, example : dict[str, str]) -> bool:
+        """Returns whether an example should be kept, and counts it for the report"""
+        self.total += 1
+        reason = self.check(example)
+        if reason is None:
+            return True
+        self.dropped[reason] += 1
+        output = self.normalize(example["output"])[:100]
+        self.droppedOutputs[output] = self.droppedOutputs.get(output, 0) + 1
+        return False
+
+    def filter(self, examples : Iterable[dict[str, str]]) -> Iterator[dict[str, str]]:
+        """Yields the examples that are kept, in order"""
+        for example in examples:
+            if self.keep(example):
+                yield example
+
+    def report(self, topCount = 20) -> dict:
+        """Returns what was dropped: how many examples for each reason, and the outputs that were dropped most often"""
+        droppedCount = sum(self.dropped.values())
+        topOutputs = sorted(self.droppedOutputs.items(), key=lambda item: -item[1])[:topCount]
+        return {
+            "examples": self.total,
+            "kept": self.total - droppedCount,
+            "dropped": dict(self.dropped),
+            "topDroppedOutputs": [{"output": output, "count": count} for (output, count) in topOutputs],
+        }
+
+    def printReport(self):
+        report = self.report(topCount = 5)
+        print(f"Kept {report['kept']} of {report['examples']} training examples. Dropped: " +
+              ", ".join(f"{count} {reason}" for (reason, count) in report["dropped"].items()))
+        for item in report["topDroppedOutputs"]:
+            print(f"\t{item['count']}x \"{item['output']}\"")
+
+
+# ----- Metrics -----
+
+# Upper bounds of histogram buckets for durations (seconds), rates (things per second) and small counts
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+class Histogram:
+    """Counts observed values in fixed buckets, along with their total count & sum. Percentiles are estimated from the buckets.
+
+    Args:
+        `buckets` : Upper bounds of the buckets, in increasing order. Values above the last one go in an overflow bucket.
+    """
+    def __init__(self, buckets : tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value : float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def copy(self) -> "Histogram":
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        (histogram.count, histogram.sum, histogram.max) = (self.count, self.sum, self.max)
+        return histogram
+
+    def since(self, previous : "Histogram") -> "Histogram":
+        """Returns a histogram of only the values observed after `previous` was copied from this one (max is still the all-time max)"""
+        histogram = Histogram(self.buckets)
+        histogram.counts = [count - previousCount for (count, previousCount) in zip(self.counts, previous.counts)]
+        (histogram.count, histogram.sum, histogram.max) = (self.count - previous.count, self.sum - previous.sum, self.max)
+        return histogram
+
+    def percentile(self, fraction : float) -> float:
+        """Returns the upper bound of the bucket that holds the given fraction (0-1) of values, which is at most max"""
+        target = fraction * self.count
+        seen = 0
+        for (bound, count) in zip(self.buckets + (self.max,), self.counts):
+            seen += count
+            if seen >= target and count > 0:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """Thread-safe counters and histograms of where time goes, each keyed by a name and optional labels (e.g. a channel).
+    Recording one takes about a microsecond, so stages can be timed on every request.
+    Use the shared `metrics` instance: metrics.count() & metrics.observe(), or `with metrics.timer(name):` around a stage.
+    They can be read through the HTTP endpoint (see startMetricsServer()) and the periodic log line (see startMetricsLog()).
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters : dict[tuple[str, tuple], float] = {}
+        self.histograms : dict[tuple[str, tuple], Histogram] = {}
+
+    def count(self, name : str, amount : float = 1, **labels):
+        """Adds `amount` to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name : str, value : float, buckets : tuple[float, ...] = SECONDS_BUCKETS, **labels):
+        """Adds a value to a histogram. `buckets` is only used when a histogram is first made."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name : str, **labels):
+        """Context manager that adds the seconds its block took to a histogram"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self) -> tuple[dict[tuple[str, tuple], float], dict[tuple[str, tuple], Histogram]]:
+        """Returns copies of all counters & histograms"""
+        with self.lock:
+            return (dict(self.counters), {key: histogram.copy() for (key, histogram) in self.histograms.items()})
+
+    @staticmethod
+    def keyName(key : tuple[str, tuple]) -> str:
+        """Returns a metric's name with its labels, e.g. 'scrape_rows_total{channel="general"}'"""
+        (name, labels) = key
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{label}="{value}"' for (label, value) in labels) + "}"
+
+    def summary(self, previous : tuple[dict, dict] = None) -> dict[str, dict[str, float] | float]:
+        """Returns every counter's value, and the count, mean, p50, p95 & max of every histogram, by name with labels.
+        If given a previous snapshot(), only what was recorded since then is summarized (except max, which is since startup).
+        """
+        (counters, histograms) = self.snapshot()
+        (previousCounters, previousHistograms) = previous if previous is not None else ({}, {})
+        result = {}
+        for (key, value) in sorted(counters.items()):
+            if value != previousCounters.get(key, 0) or previous is None:
+                result[self.keyName(key)] = value - previousCounters.get(key, 0)
+        for (key, histogram) in sorted(histograms.items()):
+            if key in previousHistograms:
+                histogram = histogram.since(previousHistograms[key])
+            if histogram.count == 0:
                 continue
+            result[self.keyName(key)] = {"count": histogram.count, "mean": round(histogram.sum / histogram.count, 6),
+                                         "p50": round(histogram.percentile(0.5), 6), "p95": round(histogram.percentile(0.95), 6), "max": round(histogram.max, 6)}
+        return result
+
+    def prometheus(self) -> str:
+        """Returns all metrics in the Prometheus text format"""
+        (counters, histograms) = self.snapshot()
+        lines = []
+        for name in sorted({name for (name, _) in counters}):
+            lines.append(f"# TYPE {name} counter")
+            lines += [f"{self.keyName(key)} {value}" for (key, value) in sorted(counters.items()) if key[0] == name]
+        for name in sorted({name for (name, _) in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for ((_, labels), histogram) in sorted(item for item in histograms.items() if item[0][0] == name):
+                cumulative = 0
+                for (bound, count) in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f"{self.keyName((name + '_bucket', labels + (('le', le),)))} {cumulative}")
+                lines.append(f"{self.keyName((name + '_sum', labels))} {histogram.sum}")
+                lines.append(f"{self.keyName((name + '_count', labels))} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class RequestProfiler:
+    """Runs individual requests under cProfile when asked to, so a slow request can be looked into in production
+    without profiling every request. Profiling is turned on for the next few requests with arm()
+    (e.g. through the metrics endpoint: `curl -X POST "localhost:<metricsPort>/profile?requests=3"`).
+    Each profile is saved as a .prof file in `outDir` (open it with pstats or snakeviz), and its slowest functions are printed.
+
+    Args:
+        `outDir` = `"profiles"` : Where to save profiles
+    """
+    def __init__(self, outDir = "profiles") -> None:
+        self.outDir = outDir
+        self.armed = 0
+        self.lock = threading.Lock()
+
+    def arm(self, requests = 1):
+        """Profiles the next `requests` requests"""
+        with self.lock:
+            self.armed += requests
+
+    def take(self) -> bool:
+        """Returns whether the request that is starting should be profiled"""
+        with self.lock:
+            if self.armed > 0:
+                self.armed -= 1
+                return True
+            return False
+
+    def run(self, label : str, func, *args, **kwargs):
+        """Calls func(*args, **kwargs) under cProfile (only the calling thread is profiled), saves & prints the profile, and returns func's result"""
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            os.makedirs(self.outDir, exist_ok=True)
+            path = os.path.join(self.outDir, f"{label}-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.prof")
+            profile.dump_stats(path)
+            stats = io.StringIO()
+            pstats.Stats(profile, stream=stats).sort_stats("cumulative").print_stats(15)
+            print(f"Profile of {label} saved to {path}\n{stats.getvalue()}")
+
+
+def startMetricsServer(port : int, host = "127.0.0.1", profiler : RequestProfiler = None) -> http.server.ThreadingHTTPServer:
+    """Serves the metrics over HTTP on a background thread, and returns the server:
+        GET /metrics : all metrics in the Prometheus text format
+        GET /metrics.json : summary of all metrics since startup, as JSON
+        POST /profile?requests=N : profile the next N requests (only if a profiler is given)
+    It only listens on localhost by default, since it has no authentication.
+    """
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def reply(self, status : int, body : str, contentType = "text/plain; charset=utf-8"):
+            data = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            path = urllib.parse.urlparse(self.path).path
+            if path == "/metrics":
+                self.reply(200, metrics.prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+            elif path == "/metrics.json":
+                self.reply(200, json.dumps(metrics.summary()), "application/json")
             else:
-                # get the previous 10 messages in this conversation
-                recentMsgHistory : list[Message] = convers[max(0, index - 10):index]
-                # if no previous message in conversation contained text, skip this message
-                if all(pastMsg.content == "" for pastMsg in recentMsgHistory):
-                    continue
-                # convert the messages into formatted messages
-                formattedMsgHistory = []
-                for unformattedMsg in recentMsgHistory:
-                    # Don't add empty messages to training data (these are usually images)
-                    if unformattedMsg.content != "":
-                        formattedMsgHistory.append(formatMsg(unformattedMsg.content, unformattedMsg.userid, names, config, True))
-                # combine them into a single chat history string
-                chatHistory = "\n".join(formattedMsgHistory)
-                # add this to the trainingOutput list
-                trainingOutput.append({
-                    "instruction": prompt,
-                    "input": chatHistory,
-                    "output": msg.content,
-                })
-    print(f"{len(trainingOutput)} sets of training data created from {len(allConversIDs)} conversations")
-    return trainingOutput
\ No newline at end of file
+                self.reply(404, "Not found\n")
+
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path != "/profile" or profiler is None:
+                self.reply(404, "Not found\n")
+                return
+            try:
+                requests = int(urllib.parse.parse_qs(url.query).get("requests", ["1"])[0])
+            except ValueError:
+                self.reply(400, "requests must be a number\n")
+                return
+            profiler.arm(requests)
+            self.reply(200, f"Profiling the next {requests} request(s)\n")
+
+        def log_message(self, format, *args):
+            pass    # don't print a line for every scrape of the endpoint
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def startMetricsLog(interval : float):
+    """Prints a summary of the metrics recorded in the last `interval` seconds as a single JSON line, every `interval` seconds, on a background thread"""
+    def logMetrics():
+        previous = metrics.snapshot()
+        while True:
+            time.sleep(interval)
+            summary = metrics.summary(previous)
+            previous = metrics.snapshot()
+            print("METRICS " + json.dumps({"time": datetime.datetime.now().isoformat(timespec="seconds"), "interval": interval, "metrics": summary}))
+    threading.Thread(target=logMetrics, name="metrics-log", daemon=True).start()
+
+
+metricsStarted = False
+
+def startMetrics(config : dict[str, (str | int | list[int])], profiler : RequestProfiler = None):
+    """Starts the metrics endpoint and the periodic metrics log line, if they are turned on in config.json.
+    Both are optional: "metricsPort" (0 = no endpoint) and "metricsLogInterval" (seconds, 0 = no log line). Only does anything the first time it is called.
+    """
+    global metricsStarted
+    if metricsStarted:
+        return
+    metricsStarted = True
+    if config.get("metricsPort", 0) > 0:
+        startMetricsServer(config["metricsPort"], profiler=profiler)
+    if config.get("metricsLogInterval", 0) > 0:
+        startMetricsLog(config["metricsLogInterval"])
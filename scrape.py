@@ -1,19 +1,24 @@
 from lib import *
+import asyncio
+import time
 
 class ScrapeClient(dc.Client):
     """Discord bot client for scraping messages.
     When activated with initBot() it will automatically scrape the channels specified in config.json.
     """
-    config = getConfig()
-    names = getNames()
-    guildID = config["guildID"]
-    channelIDs = config["channelIDs"]
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config = getConfig()
+        self.names = getNames()
+        self.guildID = self.config["guildID"]
+        self.channelIDs = self.config["channelIDs"]
     
     async def on_ready(self):
         print(f'Logged in as {self.user} (ID: {self.user.id})')
         print(f'Guild: "{self.get_guild(self.guildID)}"')
         print('------')
         
+        startMetrics(self.config)   # optional metrics endpoint & log line, see config.json
         print('Connecting to database...')
         (con, cur) = initDB()
         print('Channels to scrape:')
@@ -21,44 +26,11 @@ class ScrapeClient(dc.Client):
             print(f'\t{self.get_channel(channel)}')
         print('------')
         
-        for channel in self.channelIDs:
-            chan = self.get_channel(channel)
-            print(f'({chan}) Fetching most recent msg in db...')
-            # Fetch most recent message in db for this channel
-            mostRecentMsg = getMostRecent(con, cur, channel)
-            if mostRecentMsg != None:
-                mostRecentMsg = await chan.fetch_message(mostRecentMsg)
-            msgBatch = []
-            count = 0
-            print(f'({chan}) Scraping message history (this may take a while)...')
-            async for message in chan.history(limit=10000, after=mostRecentMsg, oldest_first=True):
-                # check if this message references another message.
-                reference = None
-                try:
-                    reference = message.reference.message_id
-                except:
-                    reference = None
-                msg = (message.id,
-                        message.channel.id,
-                        message.channel.name,
-                        message.author.id,
-                        message.author.name,
-                        str(message.created_at),
-                        message.content,
-                        reference,
-                        -1, # conversid of -1 means we have not yet assigned this message to a conversation
-                        1)
-                msgBatch.append(msg)
-                count += 1
-            print(f'({chan}) Saving {count} messages to db...')
-            try:    # try inserting new rows, then commit
-                cur.executemany("INSERT INTO Message (messageid, channelid, channelname, userid, username, sent, content, replyid, conversid, isFirstInConvers) " +
-                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", msgBatch)
-                con.commit()
-            except: # rollback if this fails
-                print("WARNING - Failed to write to database")
-                con.rollback()
-            print(f'({chan}) Done!')
+        # Scraping settings are optional in config.json
+        await scrapeChannels(con, cur, [self.get_channel(channel) for channel in self.channelIDs],
+                             requestsPerSecond = self.config.get("scrapeRequestsPerSecond", 5),
+                             chunkSize = self.config.get("scrapeChunkSize", 500))
+        print("METRICS " + json.dumps(metrics.summary()))
         print('------')
         
         print(f'Cleaning up messages...')
@@ -74,127 +46,382 @@ class ScrapeClient(dc.Client):
 
 # ----- Helper functions for ScrapeClient ----- 
 
-def cleanAllData(con : sqlite3.Connection, cur : sqlite3.Cursor):
-    """Handles cleaning & updating all message contents in db
+HISTORY_PAGE_SIZE = 100     # Number of messages Discord sends per request for a channel's history
+
+class RateBudget:
+    """A request budget shared by all the channels being scraped, so together they stay under a steady request rate.
+    (discord.py waits out any rate limits it hits, but hitting them stalls every channel, so it is better not to.)
+
+    Args:
+        `rate` : Requests per second. 0 or less means no limit.
+        `burst` = `None` : Most requests that can be made at once after being idle. Defaults to `rate` (at least 1).
+    """
+    def __init__(self, rate : float, burst : int = None) -> None:
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()  # requests are let through in the order they asked
+
+    async def acquire(self):
+        """Waits until the budget allows another request"""
+        if self.rate <= 0:
+            return
+        # Time spent waiting here (for the lock too, which is held by requests that are sleeping) is time lost to the rate limit
+        with metrics.timer("scrape_rate_limit_wait_seconds"):
+            async with self.lock:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    metrics.count("scrape_rate_limit_sleeps_total")
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def messageToRow(message : dc.Message) -> tuple:
+    """Returns a scraped message as a row for the Message table, not yet assigned to a conversation"""
+    # check if this message references another message.
+    reference = None
+    try:
+        reference = message.reference.message_id
+    except:
+        reference = None
+    return (message.id,
+            message.channel.id,
+            message.channel.name,
+            message.author.id,
+            message.author.name,
+            str(message.created_at),
+            message.content,
+            reference,
+            -1, # conversid of -1 means we have not yet assigned this message to a conversation
+            1,
+            snowflakeToMs(message.id))
+
+
+async def scrapeChannel(con : sqlite3.Connection, cur : sqlite3.Cursor, chan : dc.TextChannel, rowQueue : asyncio.Queue, budget : RateBudget) -> int:
+    """Scrapes all the messages in a channel that are newer than its scrape cursor onto `rowQueue`, and returns how many there were"""
+    # Continue after the newest message saved by the last scrape (Discord only needs its ID, not the message itself)
+    lastMessageID = getScrapeCursor(con, cur, chan.id)
+    after = dc.Object(id=lastMessageID) if lastMessageID is not None else None
+    count = 0
+    start = time.perf_counter()
+    print(f'({chan}) Scraping message history (this may take a while)...')
+    await budget.acquire()
+    async for message in chan.history(limit=None, after=after, oldest_first=True):
+        await rowQueue.put(messageToRow(message))  # waits while the writer catches up, so memory use stays flat
+        count += 1
+        if count % HISTORY_PAGE_SIZE == 0:  # the next page of history is requested when we ask for the next message
+            metrics.count("scrape_rows_total", HISTORY_PAGE_SIZE, channel=str(chan))   # counted per page, so rows/sec can be watched live
+            await budget.acquire()
+    metrics.count("scrape_rows_total", count % HISTORY_PAGE_SIZE, channel=str(chan))
+    seconds = time.perf_counter() - start
+    if count > 0:
+        metrics.observe("scrape_rows_per_second", count / seconds, RATE_BUCKETS, channel=str(chan))
+    print(f'({chan}) Done! Scraped {count} messages in {seconds:.1f}s')
+    return count
+
+
+async def writeMessages(con : sqlite3.Connection, cur : sqlite3.Cursor, rowQueue : asyncio.Queue, chunkSize : int) -> int:
+    """Inserts the rows from `rowQueue` into the database, committing every `chunkSize` rows, until it gets None. Returns how many rows were written.
+    Each commit also moves the scrape cursors of the channels in it forward, so the next scrape starts after the last committed message.
+    """
+    chunk = []
+    count = 0
+    failedChannels = set()  # channels with messages that failed to save, whose cursors must stay put so the next scrape fetches them again
+    while True:
+        row = await rowQueue.get()
+        if row is not None:
+            chunk.append(row)
+        if len(chunk) >= chunkSize or (row is None and chunk):
+            # Each channel's messages arrive oldest first, so the last one in the chunk is the newest
+            lastMessageIDs = {channelid: messageid for (messageid, channelid, *_) in chunk if channelid not in failedChannels}
+            try:    # try inserting new rows & moving the cursors, then commit
+                commitStart = time.perf_counter()
+                cur.executemany("INSERT OR IGNORE INTO Message (messageid, channelid, channelname, userid, username, sent, content, replyid, conversid, isFirstInConvers, sent_ms) " +
+                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", chunk)
+                advanceScrapeCursors(cur, lastMessageIDs)
+                con.commit()
+                metrics.observe("scrape_db_commit_seconds", time.perf_counter() - commitStart)
+                metrics.count("scrape_db_rows_total", len(chunk))
+                count += len(chunk)
+            except: # rollback if this fails
+                print("WARNING - Failed to write to database")
+                con.rollback()
+                failedChannels.update(channelid for (_, channelid, *_) in chunk)
+            chunk = []
+        if row is None:
+            return count
+
+
+async def scrapeChannels(con : sqlite3.Connection, cur : sqlite3.Cursor, channels : list[dc.TextChannel], requestsPerSecond : float = 5, chunkSize = 500, queueSize = 2000) -> int:
+    """Scrapes new messages from several channels at once into the database, and returns how many were saved.
+    Each channel is scraped by its own task, and they share one request budget. A single writer task saves their messages in chunks,
+    so the time it takes depends on the slowest channel rather than all of them added up.
+
+    Args:
+        `con` : Database connection
+        `cur` : Database cursor
+        `channels` : Channels to scrape
+        `requestsPerSecond` = `5` : Requests per second all channels can make together. 0 or less means no limit.
+        `chunkSize` = `500` : Number of messages to save per commit
+        `queueSize` = `2000` : Most scraped messages that can wait to be saved before the channels wait for the writer
+    """
+    rowQueue = asyncio.Queue(maxsize=queueSize)
+    budget = RateBudget(requestsPerSecond)
+    writer = asyncio.create_task(writeMessages(con, cur, rowQueue, chunkSize))
+    results = await asyncio.gather(*[scrapeChannel(con, cur, chan, rowQueue, budget) for chan in channels], return_exceptions=True)
+    for (chan, result) in zip(channels, results):   # one channel failing doesn't stop the others
+        if isinstance(result, Exception):
+            print(f'WARNING - ({chan}) Scraping failed: {result!r}')
+    await rowQueue.put(None)
+    count = await writer
+    print(f'Saved {count} messages to db')
+    return count
+
+
+def cleanAllData(con : sqlite3.Connection, cur : sqlite3.Cursor, names : dict[str, str] = None, config : dict[str, (str | int | list[int])] = None, chunkSize = 5000):
+    """Handles cleaning & updating the contents of every message in db that has not been cleaned by the current MsgCleaner version yet.
+    Messages are cleaned & written back in chunks, each in its own transaction, so this only takes time proportional to the new messages.
 
     Args:
         `con` : Connection to database
         `cur` : Cursor for connected database
+        `names` = `None` : dict of id/name pairs. Loaded from names.json if not given.
+        `config` = `None` : config dict. Loaded from config.json if not given.
+        `chunkSize` = `5000` : Number of messages to clean & update per transaction
     """
-    # Create a second cursor temporarily so we can update as we iterate over the first cursor.
-    # This saves us from having to load the entire database into memory at once.
-    updCur = con.cursor()
-    
     # Load both json files
-    names = getNames()
-    config = getConfig()
+    if names is None:
+        names = getNames()
+    if config is None:
+        config = getConfig()
+    cleaner = MsgCleaner(names, config)
     
+    totalCount = 0
     cleanCount = 0
     delCount = 0
-    cur.execute("SELECT * FROM Message ORDER BY sent ASC;")
-    for row in cur:     # for each message in db...
-        msg = Message(row)
-        newContent = cleanMsg(msg.content, msg.userid, names, config, isTrainingData = True) # clean the contents
-        if newContent == "":        # If the message has no content, delete it from the database. (current version keeps empty messages for testing)
-            updCur.execute("UPDATE Message SET content = ? WHERE messageID = ?;", (newContent, msg.messageid))
-            #updCur.execute("DELETE FROM Message WHERE messageID = ?;", (row[0],))
-            delCount += 1
-        elif newContent != msg.content:  # Otherwise, update it with the cleaned content if it has changed
-            updCur.execute("UPDATE Message SET content = ? WHERE messageID = ?;", (newContent, msg.messageid))
-            cleanCount += 1
-    print(f"Cleaned and updated {cleanCount} messages in Message.db")
-    print(f"There are {delCount} empty messages in Message.db")
-    con.commit()
-    updCur.close()  # close temporary cursor
+    while True:
+        # Rows we update get the current cleanver, so each query only returns messages that still need cleaning.
+        cur.execute("SELECT messageid, userid, content FROM Message WHERE cleanver < ? LIMIT ?;", (cleaner.version, chunkSize))
+        rows = cur.fetchall()
+        if not rows:
+            break
+        newContents = cleaner.clean_many([(content, userid) for (_, userid, content) in rows])   # clean the contents
+        updates = []
+        for ((messageid, _, content), newContent) in zip(rows, newContents):
+            if newContent == "":        # Empty messages are kept for now. (current version keeps empty messages for testing)
+                delCount += 1
+            elif newContent != content:
+                cleanCount += 1
+            updates.append((newContent, cleaner.version, messageid))
+        try:    # try updating this chunk, then commit
+            cur.executemany("UPDATE Message SET content = ?, cleanver = ?, tokencount = NULL WHERE messageid = ?;", updates)
+            con.commit()
+        except: # rollback if this fails
+            print("WARNING - Failed to write to database")
+            con.rollback()
+            raise
+        totalCount += len(rows)
+    print(f"Cleaned {totalCount} new messages in Message.db")
+    print(f"{cleanCount} were changed by cleaning, and {delCount} are now empty")
 
 
 
-def generateConversations(con : sqlite3.Connection, cur : sqlite3.Cursor):
+def generateConversations(con : sqlite3.Connection, cur : sqlite3.Cursor, names : dict[str, str] = None, config : dict[str, (str | int | list[int])] = None, batchSize = 5000):
     """Handles assigning conversids to each message in db that is not currently in a conversation.
     Messages are in the same conversation if they are in the same channel and are sent less than 8 hours apart (or are replying to a message).
+    Each channel is read once in the order messages were sent, and new assignments are written back in batches.
 
     Args:
         `con` : Connection to database
         `cur` : Cursor for connected database
+        `names` = `None` : dict of id/name pairs. Loaded from names.json if not given.
+        `config` = `None` : config dict. Loaded from config.json if not given.
+        `batchSize` = `5000` : Number of assignments to write to db at once
     """
     # Create a second cursor temporarily so we can update as we iterate over the first cursor.
     # This saves us from having to load the entire database into memory at once.
     updCur = con.cursor()
     
     # Load both json files
-    names = getNames()
-    config = getConfig()
+    if names is None:
+        names = getNames()
+    if config is None:
+        config = getConfig()
+    
+    # Replies to messages we haven't seen in this channel are looked up in db by their (primary key) messageid.
+    def findConversID(messageid : int) -> int | None:
+        row = updCur.execute("SELECT conversid FROM Message WHERE messageid = ?;", (messageid,)).fetchone()
+        return None if row is None else row[0]
     
     # We first need to know the highest ID used for an existing Conversation, so we don't re-use the same ID for a new one
-    cur.execute("SELECT conversid " +
-                "FROM Message " +
-                "ORDER BY conversid DESC;")
-    biggestConversID = cur.fetchone()[0]
+    biggestConversID = cur.execute("SELECT MAX(conversid) FROM Message;").fetchone()[0]
+    segmenter = ConversationSegmenter(-1 if biggestConversID is None else biggestConversID, findConversID)
     
     # We want to iterate through messages in each channel separately, since a conversation will never span multiple channels.
     for channelID in config["channelIDs"]:
-        cur.execute("SELECT * " +
+        segmenter.startChannel()
+        cur.execute("SELECT messageid, userid, sent_ms, replyid, conversid " +
                     "FROM Message " +
                     "WHERE channelid = ? " +
-                    "ORDER BY sent ASC;",
+                    "ORDER BY sent_ms ASC;",
                     (channelID,))
         sortedMsgCount = 0              # Keeps track of how many messages have been successfully sorted into a conversation
         newConversCount = 0             # Keeps track of how many new conversations have been made
-        
-        prevMsg : Message = None                # Keeps track of the previous message
-        prevMsgFromOtherUser : Message = None   # Keeps track of the previous message sent by a different user
-        prevMsgConversID : int = None           # Keeps track of the conversid of prevMsg. Must be tracked separately since we don't commit changes until the end.
+        updates = []
         
         # for each message in this channel, starting w/ the oldest...
-        for row in cur:
-            msg = Message(row)
-            # If this message has already been assigned to a conversation, skip it.
-            if msg.conversid != -1:
-                prevMsg = msg
-                prevMsgFromOtherUser = msg
+        for (messageid, userid, sentMs, replyid, conversid) in cur:
+            assigned = segmenter.assign(messageid, userid, sentMs, replyid, conversid)
+            if assigned is None:    # already in a conversation
                 continue
-            # If this is the first message in this channel, make a new conversID for it.
-            elif prevMsg == None:
-                biggestConversID += 1
-                updCur.execute("UPDATE Message SET conversid = ?, isFirstInConvers = 1 WHERE messageid = ?;", (biggestConversID, msg.messageid))
-                prevMsg = msg
-                prevMsgFromOtherUser = msg
-                prevMsgConversID = biggestConversID
-                sortedMsgCount += 1
-                newConversCount += 1
-            else:
-                # If the previous message is sent by a different user than the current message, update prevMsgFromOtherUser.
-                if msg.userid != prevMsg.userid:
-                    prevMsgFromOtherUser = prevMsg
-                
-                # If the last message from another user was more than 8 hours ago (and this message isn't a reply), make a new conversation ID for it.
-                if (msg.replyid == None) & (getDateTime(prevMsgFromOtherUser) < (getDateTime(msg) - datetime.timedelta(hours=8))):
-                    biggestConversID += 1
-                    updCur.execute("UPDATE Message SET conversid = ?, isFirstInConvers = 1 WHERE messageid = ?;", (biggestConversID, msg.messageid))
-                    prevMsg = msg
-                    prevMsgConversID = biggestConversID
-                    prevMsgFromOtherUser = msg
-                    sortedMsgCount += 1
-                    newConversCount += 1
-                # If it is a reply message, add it to the same conversation as the message it replied to.
-                elif (msg.replyid != None):
-                    updCur.execute("SELECT conversid FROM Message WHERE messageid = ?;", (msg.replyid,))
-                    conversID = updCur.fetchone()[0]
-                    updCur.execute("UPDATE Message SET conversid = ?, isFirstInConvers = 0 WHERE messageid = ?;", (conversID, msg.messageid))
-                    prevMsg = msg
-                    prevMsgConversID = conversID
-                    sortedMsgCount += 1
-                # Otherwise, add it to the same conversation as the previous message.
-                else:
-                    updCur.execute("UPDATE Message SET conversid = ?, isFirstInConvers = 0 WHERE messageid = ?;", (prevMsgConversID, msg.messageid))
-                    prevMsg = msg
-                    sortedMsgCount += 1
-        print(f"({names[str(channelID)]}) Sorted {sortedMsgCount} messages into {(newConversCount)} conversations in Message.db")
+            updates.append(assigned + (messageid,))
+            sortedMsgCount += 1
+            newConversCount += assigned[1]
+            if len(updates) >= batchSize:
+                updCur.executemany("UPDATE Message SET conversid = ?, isFirstInConvers = ? WHERE messageid = ?;", updates)
+                updates = []
+        updCur.executemany("UPDATE Message SET conversid = ?, isFirstInConvers = ? WHERE messageid = ?;", updates)
+        print(f"({names.get(str(channelID), channelID)}) Sorted {sortedMsgCount} messages into {(newConversCount)} conversations in Message.db")
     con.commit()
     updCur.close()  # close temporary cursor
 
 
 
+class MessageIngester:
+    """Keeps Message.db up to date from live message events, so the batch scrape never needs to run again.
+    Every new, edited or deleted message in the configured channels is written to db as it happens (upserted by messageid),
+    already cleaned and assigned to a conversation, just like scrape.py would have done it.
+    Call catchUp() every time the bot connects, to scrape what was missed while it was offline. Events that arrive before it is done are
+    held back and written afterward, so messages are always assigned to conversations in the order they were sent.
+    Don't run scrape.py while this is running, since both would hand out new conversids.
+
+    Args:
+        `con` : Connection to database
+        `cur` : Cursor for connected database
+        `names` : dict of id/name pairs
+        `config` : config dict
+    """
+    def __init__(self, con : sqlite3.Connection, cur : sqlite3.Cursor, names : dict[str, str], config : dict[str, (str | int | list[int])]) -> None:
+        self.con = con
+        self.cur = cur
+        self.names = names
+        self.config = config
+        self.cleaner = MsgCleaner(names, config)
+        self.segmenters : dict[int, ConversationSegmenter] = {}     # channelid -> segmenter that has seen the newest message in that channel
+        self.lastConversID = -1
+        self.ready = False
+        self.pending = []   # (method, args) of events that arrived before catchUp() was done
+
+    async def catchUp(self, channels : list[dc.TextChannel]):
+        """Scrapes, cleans & segments the messages sent since the last scrape (or since this last ran), then writes the held back events"""
+        self.ready = False
+        await scrapeChannels(self.con, self.cur, channels,
+                             requestsPerSecond = self.config.get("scrapeRequestsPerSecond", 5),
+                             chunkSize = self.config.get("scrapeChunkSize", 500))
+        # Cleaning & segmenting can take seconds on a big db (or much longer, the first time after a MsgCleaner upgrade),
+        # so it runs on a worker thread, where it doesn't block the bot's heartbeat
+        dbPath = self.cur.execute("PRAGMA database_list;").fetchone()[2]     # the file self.con is connected to
+        biggestConversID = await asyncio.to_thread(self.processScraped, dbPath)
+        self.segmenters = {}    # start over from what is in db now
+        self.lastConversID = -1 if biggestConversID is None else biggestConversID
+        self.ready = True
+        (pending, self.pending) = (self.pending, [])
+        for (method, args) in pending:
+            method(*args)
+
+    def processScraped(self, dbPath : str) -> int | None:
+        """Cleans & segments everything in the database at `dbPath` that needs it, and returns the biggest conversid.
+        Runs on a worker thread, so it uses its own connection (sqlite connections can only be used by the thread that made them).
+        """
+        con = sqlite3.connect(database=dbPath)
+        cur = con.cursor()
+        try:
+            for pragma in DB_PRAGMAS:
+                cur.execute(pragma)
+            cleanAllData(con, cur, self.names, self.config)
+            generateConversations(con, cur, self.names, self.config)
+            return cur.execute("SELECT MAX(conversid) FROM Message;").fetchone()[0]
+        finally:
+            con.close()
+
+    def findConversID(self, messageid : int) -> int | None:
+        row = self.cur.execute("SELECT conversid FROM Message WHERE messageid = ?;", (messageid,)).fetchone()
+        return None if row is None else row[0]
+
+    def getSegmenter(self, channelid : int) -> ConversationSegmenter:
+        """Returns the segmenter for a channel, which continues from the newest message in that channel"""
+        segmenter = self.segmenters.get(channelid)
+        if segmenter is None:
+            segmenter = ConversationSegmenter(self.lastConversID, self.findConversID)
+            # Every message in db is in a conversation by now, so the newest one is all the segmenter needs to follow along
+            newest = self.cur.execute("SELECT messageid, userid, sent_ms, replyid, conversid FROM Message " +
+                                      "WHERE channelid = ? ORDER BY sent_ms DESC LIMIT 1;", (channelid,)).fetchone()
+            if newest is not None:
+                segmenter.assign(*newest)
+            self.segmenters[channelid] = segmenter
+        segmenter.lastConversID = self.lastConversID    # conversids are shared by all channels
+        return segmenter
+
+    def add(self, message : dc.Message):
+        """Writes a new message to db"""
+        if not self.ready:
+            self.pending.append((self.add, (message,)))
+            return
+        (messageid, channelid, channelname, userid, username, sent, content, replyid, _, _, sentMs) = messageToRow(message)
+        if self.findConversID(messageid) is not None:  # we already have it (e.g. from catchUp()), so only its content can be new
+            self.edit(messageid, userid, content)
+            return
+        content = self.cleaner.clean(content, str(userid), isTrainingData=True)
+        segmenter = self.getSegmenter(channelid)
+        (conversid, isFirstInConvers) = segmenter.assign(messageid, userid, sentMs, replyid)
+        self.lastConversID = segmenter.lastConversID
+        try:
+            self.cur.execute("INSERT INTO Message (messageid, channelid, channelname, userid, username, sent, content, replyid, conversid, isFirstInConvers, cleanver, sent_ms) " +
+                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) " +
+                             "ON CONFLICT (messageid) DO UPDATE SET content = excluded.content, cleanver = excluded.cleanver, tokencount = NULL;",
+                             (messageid, channelid, channelname, userid, username, sent, content, replyid, conversid, isFirstInConvers, self.cleaner.version, sentMs))
+            advanceScrapeCursors(self.cur, {channelid: messageid})  # so the next catchUp() doesn't scrape it again
+            self.con.commit()
+        except: # rollback if this fails
+            print("WARNING - Failed to write to database")
+            self.con.rollback()
+
+    def edit(self, messageid : int, userid : int, content : str):
+        """Updates the content of a message in db. Messages that aren't in db are ignored."""
+        if not self.ready:
+            self.pending.append((self.edit, (messageid, userid, content)))
+            return
+        try:
+            self.cur.execute("UPDATE Message SET content = ?, cleanver = ?, tokencount = NULL WHERE messageid = ?;",
+                             (self.cleaner.clean(content, str(userid), isTrainingData=True), self.cleaner.version, messageid))
+            self.con.commit()
+        except: # rollback if this fails
+            print("WARNING - Failed to write to database")
+            self.con.rollback()
+
+    def delete(self, messageid : int):
+        """Removes a message from db. If it started a conversation, the next message in that conversation starts it instead."""
+        if not self.ready:
+            self.pending.append((self.delete, (messageid,)))
+            return
+        try:
+            row = self.cur.execute("SELECT conversid, isFirstInConvers FROM Message WHERE messageid = ?;", (messageid,)).fetchone()
+            self.cur.execute("DELETE FROM Message WHERE messageid = ?;", (messageid,))
+            if row is not None and row[0] != -1 and row[1] == 1:
+                self.cur.execute("UPDATE Message SET isFirstInConvers = 1 WHERE messageid = " +
+                                 "(SELECT messageid FROM Message WHERE conversid = ? ORDER BY sent_ms ASC LIMIT 1);", (row[0],))
+            self.con.commit()
+        except: # rollback if this fails
+            print("WARNING - Failed to write to database")
+            self.con.rollback()
+
+
+
 # Code for running scrape bot
 def runScrapeBot():
     intents = dc.Intents.default()
@@ -203,4 +430,5 @@ def runScrapeBot():
     client = ScrapeClient(intents=intents)
     initBot(client)
 
-runScrapeBot()
\ No newline at end of file
+if __name__ == "__main__":
+    runScrapeBot()
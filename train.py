@@ -1,88 +1,569 @@
 from lib import *
-from datasets import load_dataset
-import trl
+import datasets
+import hashlib
+import heapq
 import json
+import shutil
+import tempfile
+import time
+import trl
 import transformers
 
 # A good chunk of the SFTTrainer code comes from
 # https://github.com/huggingface/trl/pull/444#issue-1760952763
 
-model = transformers.AutoModelForCausalLM.from_pretrained("facebook/opt-350m")
-tokenizer = transformers.AutoTokenizer.from_pretrained("facebook/opt-350m")
-
 # Makes loss calculations ignore the "### Repsonse:" label
 response_template = """### Response:
 """
-collator = trl.DataCollatorForCompletionOnlyLM(response_template, tokenizer=tokenizer)
+
+# How each training example is laid out for the AI
+prompt_template = """### Instruction:
+{instruction}
+
+### Input:
+{input}
+
+### Response:
+{output}"""
+
+max_seq_length = 1024       # Examples longer than this many tokens are truncated
+# How examples are put into batches:
+#   "none"    : batches of random examples, each padded to its longest example (the original behavior)
+#   "length"  : batches of examples with similar lengths, so there is much less padding
+#   "packing" : several examples are packed into each sequence of up to max_seq_length tokens, so there is almost no padding
+batching_mode = "none"
+dataset_cache_format = 2    # Bump this whenever the columns stored in the dataset cache change
+# Near-duplicate & low-value examples (copy-pasted chats, spam, repeated memes, echoes) are dropped before training (see ExampleDeduplicator)
+dedup_examples = True
+dedup_input_threshold = 0.8     # How similar (0-1) two examples' chat histories must be for them to count as duplicates
+dedup_output_threshold = 0.8    # How similar (0-1) two responses must be to count as the same response
+dedup_max_output_repeats = 3    # Most examples that may have the same response (0 = no limit)
+dedup_min_chars = 20            # Responses shorter than this (like "lol") are only dropped as part of a duplicate example
+dedup_report_loc = 'db' + os.sep + 'dedup_report.json'   # What was dropped, written after each run
+dataset_loc = 'db' + os.sep + 'input_output_dataset.jsonl'
+dataset_cache_dir = 'db' + os.sep + 'dataset_cache'
+model_loc = 'model.bin'
+trainer_dir = './tmp_trainer'   # Checkpoints & the run manifest go here (see "Resumable training runs" below)
+fold_count = 10
+# User IDs of the personas to train models for. None trains one for every persona in config.json (userToImpersonateID and "personas").
+# The datasets of all personas are made in one pass over Message.db either way.
+# Each persona's files are named with personaPath(), e.g. "model-<userID>.bin" (userToImpersonateID keeps the names above).
+train_personas = None
 
 
 def formatting_prompts_func(examples):
     output_text = []
 
     for i in range(len(examples["instruction"])):
-        prompt = examples["instruction"][i]
-        input_text = examples["input"][i]
-        response = examples["output"][i]
-        text = f"""### Instruction:
-{prompt}
-
-### Input:
-{input_text}
-
-### Response:
-{response}"""
+        text = prompt_template.format(instruction=examples["instruction"][i], input=examples["input"][i], output=examples["output"][i])
         output_text.append(text)
     return output_text
 
-#TODO: This is super inefficient. Maybe I can simplify it?
-(con, cur) = initDB()
-trainingData = generateTrainingData(con, cur)
-dataset_loc = 'db' + os.sep + 'input_output_dataset.json'
-# Save this to a json file, then immediately load it for SFTTrainer
-with open(dataset_loc, 'w') as f:
-    json.dump(trainingData, f)
-    f.close()
-
-dataset = load_dataset("json", data_files = dataset_loc)
-
-# Manually split our dataset into 10 distinct 90-10% splits for training/evaluation respectively. This will let us manually cross-validate.
-split_dataset = dataset['train'].train_test_split(test_size=0.2)
-val_ds = load_dataset("json", data_files = dataset_loc, split=[f"train[{k}%:{k+10}%]" for k in range(0, 100, 10)])
-train_ds = load_dataset("json", data_files = dataset_loc, split=[f"train[:{k}%]+train[{k+10}%:]" for k in range(0, 100, 10)])
-print("-----")
-
-trainingArgs = transformers.TrainingArguments(
-    output_dir= './tmp_trainer',
-    num_train_epochs = 10,          # (On each dataset) Train for 10 epochs, then save the best checkpoint. Increase/decrease this as needed.
-    load_best_model_at_end = True,  # Best checkpoint is always saved (counts toward total save limit defined below)
-    save_total_limit = 10,          # Saves 10 most recent checkpoints before deleting oldest. Checkpoints are big files, but you can increase this number if you have enough space.
-    save_strategy = "epoch",        # Save a checkpoint of the model at the end of each epoch.
-    evaluation_strategy = "epoch",  # Evaluate the model at the end of each epoch. This gives us an eval_loss value to determine which checkpoint is the current best.
-    logging_strategy = "epoch",     # Make a log at the end of each epoch.
-    weight_decay = 0.001,
-)
-
-# iterate through our cross-validation dataset splits
-for trainerNum, train_dataset, val_dataset in zip(range(10), train_ds, val_ds):
-    print(f"Running Trainer {trainerNum+1}")
-    trainer = trl.SFTTrainer(
-        model,
-        args = trainingArgs,
-        tokenizer = tokenizer,
-        train_dataset = train_dataset,
-        eval_dataset = val_dataset,
-        formatting_func = formatting_prompts_func,
-        max_seq_length = 1024,
-        packing = False,
-        dataset_batch_size = 16,
-        data_collator = collator,
-        callbacks=[transformers.EarlyStoppingCallback(early_stopping_patience=2)],  # Stop training with this dataset split if the eval_loss gets worse for n epochs.
+
+# ----- Dataset cache -----
+
+def hashFile(path : str) -> str:
+    """Returns the sha256 hex digest of a file's contents"""
+    fileHash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            fileHash.update(block)
+    return fileHash.hexdigest()
+
+
+def tokenizerFingerprint(tokenizer : transformers.PreTrainedTokenizerBase) -> str:
+    """Returns a hash that changes whenever the tokenizer would tokenize text differently"""
+    if tokenizer.is_fast:
+        description = tokenizer.backend_tokenizer.to_str()
+    else:
+        description = tokenizer.name_or_path + json.dumps(tokenizer.get_vocab(), sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def loadTokenizedDataset(tokenizer : transformers.PreTrainedTokenizerBase, chunkSize = 1000,
+                         datasetLoc = dataset_loc, cacheDir = dataset_cache_dir) -> datasets.Dataset:
+    """Returns the training data in datasetLoc, formatted with prompt_template and tokenized, as a memory-mapped Arrow dataset.
+
+    Results are cached in cacheDir, keyed by a hash of the training data (i.e. the contents of Message.db that end up in it),
+    the prompt template and the tokenizer. If nothing changed since the last run, the cached dataset is loaded as-is.
+    Otherwise, examples that are also in the previous cache reuse its token IDs, so only new or changed examples are tokenized.
+
+    Args:
+        `tokenizer` : Tokenizer of the model being trained
+        `chunkSize` = `1000` : Number of examples to tokenize at once
+        `datasetLoc` = `dataset_loc` : .jsonl file of training data to load
+        `cacheDir` = `dataset_cache_dir` : Where to cache the tokenized dataset. Use a different one for each datasetLoc,
+         since only the newest cache in it is kept.
+    """
+    tokenizerHash = tokenizerFingerprint(tokenizer)
+    cacheKey = hashlib.sha256("|".join([hashFile(datasetLoc), prompt_template, tokenizerHash, str(max_seq_length), str(dataset_cache_format)]).encode()).hexdigest()[:16]
+    cacheLoc = cacheDir + os.sep + cacheKey
+    if os.path.isdir(cacheLoc):
+        print(f"Training data is unchanged, loading cached dataset {cacheKey}")
+        return datasets.load_from_disk(cacheLoc)
+    os.makedirs(cacheDir, exist_ok=True)
+
+    # Find a previous cache made with the same tokenizer, so we can reuse the token IDs of examples that haven't changed.
+    previous : datasets.Dataset = None
+    previousRows : dict[str, int] = {}     # examplehash -> row in previous
+    for oldKey in os.listdir(cacheDir):
+        try:
+            with open(cacheDir + os.sep + oldKey + os.sep + "kcbot_cache.json", 'r') as f:
+                meta = json.loads(f.read())
+        except (OSError, ValueError):
+            continue
+        if meta["tokenizer"] == tokenizerHash and meta["max_seq_length"] == max_seq_length:
+            previous = datasets.load_from_disk(cacheDir + os.sep + oldKey)
+            previousRows = {exampleHash: row for (row, exampleHash) in enumerate(previous["examplehash"])}
+            break
+
+    counts = {"reused": 0, "tokenized": 0}
+    def generateRows(dataHash : str):
+        """Yields formatted & tokenized examples, in the same order as datasetLoc. (dataHash only makes the generator's fingerprint unique)"""
+        with open(datasetLoc, 'r') as f:
+            while True:
+                lines = [line for line in (f.readline() for _ in range(chunkSize)) if line.strip() != ""]
+                if not lines:
+                    break
+                examples = [json.loads(line) for line in lines]
+                texts = formatting_prompts_func({key: [example[key] for example in examples] for key in ("instruction", "input", "output")})
+                hashes = [hashlib.sha1(text.encode()).hexdigest() for text in texts]
+                # Tokenize only the examples that weren't in the previous cache
+                newIndexes = [i for (i, exampleHash) in enumerate(hashes) if exampleHash not in previousRows]
+                tokens = {}
+                if newIndexes:
+                    encoded = tokenizer([texts[i] for i in newIndexes], add_special_tokens=True, truncation=True, max_length=max_seq_length, padding=False)
+                    for (n, i) in enumerate(newIndexes):
+                        tokens[i] = (encoded["input_ids"][n], encoded["attention_mask"][n])
+                reusedIndexes = [i for i in range(len(texts)) if i not in tokens]
+                if reusedIndexes:
+                    old = previous[[previousRows[hashes[i]] for i in reusedIndexes]]
+                    for (n, i) in enumerate(reusedIndexes):
+                        tokens[i] = (old["input_ids"][n], old["attention_mask"][n])
+                counts["tokenized"] += len(newIndexes)
+                counts["reused"] += len(reusedIndexes)
+                for i in range(len(texts)):
+                    yield {"text": texts[i], "examplehash": hashes[i], "conversid": examples[i].get("conversid"),
+                           "input_ids": tokens[i][0], "attention_mask": tokens[i][1], "length": len(tokens[i][0])}
+
+    # Build the new cache in a temp dir and move it into place once it is complete, so an interrupted run never leaves a broken cache.
+    with tempfile.TemporaryDirectory(dir=cacheDir) as tmpDir:
+        dataset = datasets.Dataset.from_generator(generateRows, gen_kwargs={"dataHash": cacheKey}, cache_dir=tmpDir + os.sep + "build")
+        dataset.save_to_disk(tmpDir + os.sep + cacheKey)
+        with open(tmpDir + os.sep + cacheKey + os.sep + "kcbot_cache.json", 'w') as f:
+            f.write(json.dumps({"tokenizer": tokenizerHash, "max_seq_length": max_seq_length}))
+        del dataset
+        os.replace(tmpDir + os.sep + cacheKey, cacheLoc)
+    print(f"Cached dataset {cacheKey}: tokenized {counts['tokenized']} examples, reused {counts['reused']} from the previous cache")
+
+    # Only the newest cache is kept, since it is all we need to reuse next time
+    del previous
+    for oldKey in os.listdir(cacheDir):
+        if oldKey != cacheKey and os.path.isfile(cacheDir + os.sep + oldKey + os.sep + "kcbot_cache.json"):
+            shutil.rmtree(cacheDir + os.sep + oldKey, ignore_errors=True)
+    return datasets.load_from_disk(cacheLoc)
+
+
+# ----- Cross-validation -----
+
+def buildFolds(dataset : datasets.Dataset, foldCount = 10, groupColumn = "conversid") -> list[tuple[datasets.Dataset, datasets.Dataset]]:
+    """Splits a dataset into (train, validation) pairs for cross-validation, where each validation split holds about
+    1/foldCount of the examples and the matching train split holds the rest.
+    Every split is an index view over the same underlying Arrow table (Dataset.select), so no example data is ever copied.
+    Returns `foldCount` folds, or fewer if there are fewer groups than that (a fold with no validation examples can't be evaluated).
+
+    Args:
+        `dataset` : Dataset to split
+        `foldCount` = `10` : Number of folds
+        `groupColumn` = `"conversid"` : Examples with the same value in this column always end up on the same side of every fold,
+         so a conversation never leaks between the train and validation splits. Ignored if the dataset has no such column.
+    """
+    n = len(dataset)
+    if groupColumn not in dataset.column_names:
+        # Every example is its own group, so each validation split is simply the next 1/foldCount of the examples
+        foldIndexes = [list(range(n * k // foldCount, n * (k + 1) // foldCount)) for k in range(foldCount)]
+    else:
+        groupIndexes : dict[object, list[int]] = {}     # group -> its examples, in order of first appearance
+        for (i, group) in enumerate(dataset[groupColumn]):
+            groupIndexes.setdefault(group, []).append(i)
+        # Hand out whole groups, biggest first, each to the fold with the fewest examples so far. This keeps the folds about the same size
+        # even when one conversation holds a big part of the dataset (active servers rarely go quiet long enough to start a new one).
+        foldIndexes = [[] for _ in range(foldCount)]
+        sizes = [(0, k) for k in range(foldCount)]     # heap of (examples, fold)
+        groupsBySize = sorted(groupIndexes.values(), key=len, reverse=True)
+        oversized = sum(1 for indexes in groupsBySize if len(indexes) > n / foldCount)
+        if oversized:
+            print(f"WARNING - {oversized} conversation(s) hold more examples than a fold should (the biggest has {len(groupsBySize[0])} of {n}), " +
+                  "so the folds will be uneven")
+        for indexes in groupsBySize:
+            (size, k) = heapq.heappop(sizes)
+            foldIndexes[k].extend(indexes)
+            heapq.heappush(sizes, (size + len(indexes), k))
+    
+    emptyFolds = sum(1 for indexes in foldIndexes if not indexes)
+    if emptyFolds:
+        print(f"WARNING - Only {foldCount - emptyFolds} cross-validation folds could be made, since there are fewer conversations than folds")
+    folds = []
+    for indexes in foldIndexes:
+        if not indexes:
+            continue
+        indexes.sort()
+        valSet = set(indexes)
+        train = dataset.select([i for i in range(n) if i not in valSet])
+        val = dataset.select(indexes)
+        folds.append((train, val))
+    return folds
+
+
+# ----- Batching -----
+
+def packDataset(dataset : datasets.Dataset, tokenizer : transformers.PreTrainedTokenizerBase, chunkSize = 1000) -> datasets.Dataset:
+    """Packs the examples of a tokenized dataset into sequences of up to max_seq_length tokens, with as little space left over as possible.
+    Each packed sequence has a "labels" column where everything except the "### Response:" part of each example is masked out (-100),
+    so the loss is still only calculated on responses, the same as with DataCollatorForCompletionOnlyLM.
+    Examples in the same sequence can attend to each other (the same as SFTTrainer's own packing), which costs a little accuracy for a lot of speed.
+
+    Args:
+        `dataset` : Tokenized dataset (or fold) to pack
+        `tokenizer` : Tokenizer of the model being trained
+        `chunkSize` = `1000` : Examples are packed in chunks of this many (first-fit decreasing within each chunk)
+    """
+    responseIDs = tokenizer.encode(response_template, add_special_tokens=False)
+
+    def labelsFor(inputIDs : list[int]) -> list[int]:
+        # Find the last "### Response:" label, and only keep labels for the tokens after it
+        for start in range(len(inputIDs) - len(responseIDs), -1, -1):
+            if inputIDs[start:start + len(responseIDs)] == responseIDs:
+                responseStart = start + len(responseIDs)
+                return [-100] * responseStart + inputIDs[responseStart:]
+        return [-100] * len(inputIDs)      # the response was truncated away, so there is nothing to learn from this example
+
+    def pack(batch):
+        order = sorted(range(len(batch["input_ids"])), key=lambda i: len(batch["input_ids"][i]), reverse=True)
+        bins : list[tuple[list[int], list[int]]] = []   # (input_ids, labels) of each packed sequence
+        for i in order:
+            inputIDs = batch["input_ids"][i]
+            for (binIDs, binLabels) in bins:
+                if len(binIDs) + len(inputIDs) <= max_seq_length:
+                    break
+            else:
+                (binIDs, binLabels) = ([], [])
+                bins.append((binIDs, binLabels))
+            binIDs.extend(inputIDs)
+            binLabels.extend(labelsFor(inputIDs))
+        return {
+            "input_ids": [binIDs for (binIDs, _) in bins],
+            "attention_mask": [[1] * len(binIDs) for (binIDs, _) in bins],
+            "labels": [binLabels for (_, binLabels) in bins],
+            "length": [len(binIDs) for (binIDs, _) in bins],
+        }
+
+    return dataset.map(pack, batched=True, batch_size=chunkSize, remove_columns=dataset.column_names)
+
+
+class CountingCollator:
+    """Wraps a data collator and counts how many real (non-padding) tokens and total tokens go through it.
+    
+    Args:
+        `collator` : The data collator to wrap
+    """
+    def __init__(self, collator) -> None:
+        self.collator = collator
+        self.realTokens = 0
+        self.totalTokens = 0
+
+    def __call__(self, features):
+        batch = self.collator(features)
+        self.realTokens += int(batch["attention_mask"].sum())
+        self.totalTokens += batch["attention_mask"].numel()
+        return batch
+
+
+class ThroughputCallback(transformers.TrainerCallback):
+    """Prints the training throughput (real tokens/sec) and padding ratio at the end of each epoch.
+    
+    Args:
+        `counter` : The CountingCollator used by the trainer
+    """
+    def __init__(self, counter : CountingCollator) -> None:
+        self.counter = counter
+        self.epochStart = time.perf_counter()
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        # Evaluation batches also go through the collator after each epoch, so start counting fresh
+        self.counter.realTokens = 0
+        self.counter.totalTokens = 0
+        self.epochStart = time.perf_counter()
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        seconds = time.perf_counter() - self.epochStart
+        paddingRatio = 1 - self.counter.realTokens / max(self.counter.totalTokens, 1)
+        print(f"Epoch {state.epoch:.0f}: {self.counter.realTokens / seconds:,.0f} tokens/sec, " +
+              f"{paddingRatio:.1%} of {self.counter.totalTokens:,} batch tokens were padding (batching mode: {batching_mode})")
+
+
+# ----- Resumable training runs -----
+# Each persona's run keeps a manifest in its trainer_dir that records the dataset it was started with and every completed fold
+# (with its best checkpoint & eval_loss). Each fold has its own checkpoint dir ("fold-<n>"), and the best model of the last completed fold
+# is kept in "fold-<n>-best" as the starting point of the next fold. If train.py is stopped, the next run with the same dataset
+# picks up from the latest checkpoint of the fold it was in. Files are only ever replaced by renaming a complete copy into place,
+# and deleted by renaming them out of the way first, so a crash at any point leaves a run that can be resumed.
+
+run_manifest_name = "kcbot_run.json"
+run_manifest_format = 2     # Bump this whenever the manifest or the meaning of its fields changes, so old runs start over
+fold_dir_regex = re.compile(r"fold-\d+(-best)?")
+checkpoint_regex = re.compile(r"checkpoint-\d+")
+
+
+def trainingRunHash(datasetLoc : str) -> str:
+    """Returns a hash of the dataset and the settings that decide what each fold trains on. A run can only be resumed if this is unchanged."""
+    return hashlib.sha256("|".join([hashFile(datasetLoc), prompt_template, str(max_seq_length), batching_mode, str(fold_count),
+                                    str(run_manifest_format)]).encode()).hexdigest()
+
+
+def loadManifest(outputDir : str) -> dict | None:
+    """Returns the manifest of the training run in outputDir, or None if there isn't a readable one"""
+    try:
+        with open(outputDir + os.sep + run_manifest_name, 'r') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def saveManifest(outputDir : str, manifest : dict):
+    """Writes a run's manifest by replacing the old one with a complete new copy, so it is never half-written"""
+    os.makedirs(outputDir, exist_ok=True)
+    tmpLoc = outputDir + os.sep + run_manifest_name + ".tmp"
+    with open(tmpLoc, 'w') as f:
+        f.write(json.dumps(manifest, indent=2))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpLoc, outputDir + os.sep + run_manifest_name)
+
+
+def pruneDir(path : str):
+    """Deletes a directory. It is renamed first, so a crash part way through never leaves something that looks like a complete checkpoint."""
+    if not os.path.exists(path):
+        return
+    prunedLoc = path + ".pruning"
+    shutil.rmtree(prunedLoc, ignore_errors=True)    # left over from an interrupted prune
+    os.replace(path, prunedLoc)
+    shutil.rmtree(prunedLoc, ignore_errors=True)
+
+
+def replaceDir(src : str, dst : str):
+    """Moves the directory src to dst, replacing whatever is there. If this is interrupted, restoreDir(dst) puts back whichever copy is complete."""
+    oldLoc = dst + ".old"
+    pruneDir(oldLoc)
+    if os.path.exists(dst):
+        os.replace(dst, oldLoc)
+    os.replace(src, dst)
+    pruneDir(oldLoc)
+
+
+def restoreDir(dst : str):
+    """Finishes a replaceDir() that was interrupted between moving dst out of the way and moving the new copy in"""
+    if not os.path.exists(dst) and os.path.exists(dst + ".old"):
+        os.replace(dst + ".old", dst)
+
+
+def latestCheckpoint(foldDir : str) -> str | None:
+    """Returns the newest complete checkpoint in a fold's dir, or None. A checkpoint is only complete once the Trainer wrote its trainer_state.json,
+    which it writes last, so checkpoints interrupted while being saved are skipped (and pruned by pruneRun()).
+    """
+    if not os.path.isdir(foldDir):
+        return None
+    checkpoints = [name for name in os.listdir(foldDir) if checkpoint_regex.fullmatch(name)
+                   and os.path.isfile(foldDir + os.sep + name + os.sep + "trainer_state.json")]
+    if not checkpoints:
+        return None
+    return foldDir + os.sep + max(checkpoints, key=lambda name: int(name.split("-")[1]))
+
+
+def pruneRun(outputDir : str, manifest : dict):
+    """Deletes everything in a run's dir that it no longer needs: the checkpoints of completed folds, the best models of all but the last
+    completed fold, incomplete checkpoints of the current fold, and anything left over from an interrupted save or delete.
+    Anything else in outputDir is left alone.
+    """
+    if not os.path.isdir(outputDir):
+        return
+    currentFold = f"fold-{len(manifest['folds']) + 1}"
+    keep = {currentFold}
+    if manifest["folds"]:
+        keep.add(os.path.basename(manifest["folds"][-1]["model"]))
+    for name in os.listdir(outputDir):
+        path = outputDir + os.sep + name
+        if name.endswith(".pruning"):
+            shutil.rmtree(path, ignore_errors=True)
+        # (".tmp" & ".old" copies are left by a save or replaceDir() that was interrupted)
+        elif fold_dir_regex.fullmatch(name.removesuffix(".tmp").removesuffix(".old")) and name not in keep and os.path.isdir(path):
+            pruneDir(path)
+    foldDir = outputDir + os.sep + currentFold
+    if os.path.isdir(foldDir):
+        for name in os.listdir(foldDir):
+            path = foldDir + os.sep + name
+            if name.endswith(".pruning"):
+                shutil.rmtree(path, ignore_errors=True)
+            elif checkpoint_regex.fullmatch(name) and not os.path.isfile(path + os.sep + "trainer_state.json"):
+                pruneDir(path)
+
+
+def canResume(userID : int, config : dict[str, (str | int | list[int])]) -> bool:
+    """Returns whether a persona has an unfinished training run that can be resumed with the dataset it started with"""
+    manifest = loadManifest(personaPath(trainer_dir, userID, config))
+    datasetLoc = personaPath(dataset_loc, userID, config)
+    return (manifest is not None and not manifest.get("finished", False) and os.path.isfile(datasetLoc)
+            and manifest.get("runHash") == trainingRunHash(datasetLoc))
+
+
+# ----- Training -----
+
+def writeDatasets(userIDs : list[int], config : dict[str, (str | int | list[int])]):
+    """Writes the training data of each persona to its own .jsonl file, from a single pass over Message.db"""
+    (con, cur) = initDB()
+    examples = iterPersonaTrainingData(con, cur, userIDs, config = config)
+    if dedup_examples:
+        # Each persona gets its own deduplicator, since examples are only duplicates of examples in the same dataset
+        dedups = {userID: ExampleDeduplicator(dedup_input_threshold, dedup_output_threshold, dedup_max_output_repeats, dedup_min_chars)
+                  for userID in userIDs}
+        examples = ((userID, example) for (userID, example) in examples if dedups[userID].keep(example))
+    # Stream the training data straight into JSON Lines files, without holding it all in memory
+    writePersonaTrainingData(examples, {userID: personaPath(dataset_loc, userID, config) for userID in userIDs})
+    cur.close()
+    con.close()
+    if dedup_examples:
+        for (userID, dedup) in dedups.items():
+            if len(userIDs) > 1:
+                print(f"Persona {userID}:")
+            dedup.printReport()
+            with open(personaPath(dedup_report_loc, userID, config), "w", encoding="utf-8") as f:
+                json.dump(dedup.report(), f, indent=2)
+
+
+def runTraining():
+    config = getConfig()
+    userIDs = train_personas if train_personas is not None else getPersonaIDs(config)
+    # Personas with an unfinished run keep the dataset it was started with, so they can pick up where they left off
+    resuming = [userID for userID in userIDs if canResume(userID, config)]
+    if len(resuming) < len(userIDs):
+        writeDatasets([userID for userID in userIDs if userID not in resuming], config)
+    for userID in userIDs:
+        print(f"----- Training persona {userID} -----")
+        trainPersona(userID, config)
+
+
+def trainPersona(userID : int, config : dict[str, (str | int | list[int])]):
+    """Trains a persona's model on its dataset (written by writeDatasets()) and saves it to its model location.
+    Resumes the persona's unfinished training run if there is one for the same dataset (see "Resumable training runs").
+    """
+    modelLoc = personaPath(model_loc, userID, config)
+    outputDir = personaPath(trainer_dir, userID, config)
+    datasetLoc = personaPath(dataset_loc, userID, config)
+    restoreDir(modelLoc)
+
+    runHash = trainingRunHash(datasetLoc)
+    manifest = loadManifest(outputDir)
+    if manifest is not None and not manifest.get("finished", False) and manifest.get("runHash") == runHash:
+        print(f"Resuming training run started {manifest['started']}: {len(manifest['folds'])} folds complete")
+    else:
+        if manifest is not None and not manifest.get("finished", False):
+            print("The dataset or training settings changed since the last training run was started, so it is starting over")
+        manifest = {"format": run_manifest_format, "runHash": runHash, "started": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "finished": False, "folds": []}
+        # Clear out the folds of the old run before the new manifest says they aren't needed, so they can't be mistaken for this run's
+        for name in (os.listdir(outputDir) if os.path.isdir(outputDir) else []):
+            if fold_dir_regex.fullmatch(name):
+                pruneDir(outputDir + os.sep + name)
+        saveManifest(outputDir, manifest)
+    pruneRun(outputDir, manifest)
+
+    # Each fold starts from the best model of the fold before it
+    model = manifest["folds"][-1]["model"] if manifest["folds"] else "facebook/opt-350m"
+    model = transformers.AutoModelForCausalLM.from_pretrained(model)
+    tokenizer = transformers.AutoTokenizer.from_pretrained("facebook/opt-350m")
+    if batching_mode == "packing":
+        # Packed sequences already have their labels masked, so they only need padding
+        collator = transformers.DataCollatorForSeq2Seq(tokenizer, label_pad_token_id=-100)
+    else:
+        collator = trl.DataCollatorForCompletionOnlyLM(response_template, tokenizer=tokenizer)
+    counter = CountingCollator(collator)
+
+    dataset = loadTokenizedDataset(tokenizer, datasetLoc = datasetLoc, cacheDir = personaPath(dataset_cache_dir, userID, config))
+
+    # Manually split our dataset into 10 distinct 90-10% splits for training/evaluation respectively. This will let us manually cross-validate.
+    start = time.perf_counter()
+    folds = buildFolds(dataset, fold_count)
+    train_ds = [train for (train, _) in folds]
+    val_ds = [val for (_, val) in folds]
+    # Each fold only stores 8 bytes per row it selects, where copying the data would store the whole example again.
+    selectedRows = sum(len(train) + len(val) for (train, val) in folds)
+    print(f"Built {len(folds)} cross-validation folds in {time.perf_counter() - start:.2f}s, as {selectedRows * 8 / 2**20:.1f} MiB of indices " +
+          f"over one {dataset.data.nbytes / 2**20:.1f} MiB dataset (copying each fold would take {selectedRows / max(len(dataset), 1) * dataset.data.nbytes / 2**20:.1f} MiB)")
+    print("-----")
+
+    trainingArgs = dict(
+        num_train_epochs = 10,          # (On each dataset) Train for 10 epochs, then save the best checkpoint. Increase/decrease this as needed.
+        load_best_model_at_end = True,  # Best checkpoint is always saved (counts toward total save limit defined below)
+        save_total_limit = 2,           # Keeps the 2 most recent checkpoints of each fold (and the best one), which is all a resumed run needs. Checkpoints are big files.
+        save_strategy = "epoch",        # Save a checkpoint of the model at the end of each epoch.
+        evaluation_strategy = "epoch",  # Evaluate the model at the end of each epoch. This gives us an eval_loss value to determine which checkpoint is the current best.
+        logging_strategy = "epoch",     # Make a log at the end of each epoch.
+        weight_decay = 0.001,
+        group_by_length = batching_mode == "length",   # Batch examples of similar length together (uses the "length" column)
     )
-    # You can turn this on if your GPU is CUDA-enabled. Only do this if you have a GPU with more memory than your CPU (or a lot of GPUs).
-    # Be sure to first reinstall pytorch with CUDA via the instructions at https://pytorch.org/get-started/locally/
-    # model.cuda()
-    trainer.train()
-    trainer.save_model("model.bin")
-    print(f"Trainer {trainerNum+1}/10 complete.")
-    # At this point, our best model for that dataset split has been saved to "model.bin", so load that as the starting model for our next trainer
-    model = "model.bin"
\ No newline at end of file
+
+    # iterate through our cross-validation dataset splits, skipping the ones this run already finished
+    for trainerNum, train_dataset, val_dataset in zip(range(len(folds)), train_ds, val_ds):
+        if trainerNum < len(manifest["folds"]):
+            continue
+        foldDir = outputDir + os.sep + f"fold-{trainerNum+1}"
+        checkpoint = latestCheckpoint(foldDir)
+        print(f"Running Trainer {trainerNum+1}" + (f" from {checkpoint}" if checkpoint is not None else ""))
+        if batching_mode == "packing":
+            train_dataset = packDataset(train_dataset, tokenizer)
+            val_dataset = packDataset(val_dataset, tokenizer)
+        trainer = trl.SFTTrainer(
+            model,
+            args = transformers.TrainingArguments(output_dir = foldDir, **trainingArgs),
+            tokenizer = tokenizer,
+            train_dataset = train_dataset,
+            eval_dataset = val_dataset,
+            max_seq_length = max_seq_length,
+            packing = False,
+            dataset_text_field = "text",
+            dataset_kwargs = {"skip_prepare_dataset": True},   # Our datasets are already formatted & tokenized
+            data_collator = counter,
+            callbacks=[transformers.EarlyStoppingCallback(early_stopping_patience=2),  # Stop training with this dataset split if the eval_loss gets worse for n epochs.
+                       ThroughputCallback(counter)],
+        )
+        # You can turn this on if your GPU is CUDA-enabled. Only do this if you have a GPU with more memory than your CPU (or a lot of GPUs).
+        # Be sure to first reinstall pytorch with CUDA via the instructions at https://pytorch.org/get-started/locally/
+        # model.cuda()
+        trainer.train(resume_from_checkpoint = checkpoint)
+
+        # Save the best model of this fold, then record it in the manifest. Only then are the checkpoints it came from deleted.
+        bestDir = foldDir + "-best"
+        pruneDir(bestDir + ".tmp")
+        trainer.save_model(bestDir + ".tmp")
+        replaceDir(bestDir + ".tmp", bestDir)
+        # modelLoc always holds the newest best model, so it can be chatted with while the other folds train
+        pruneDir(modelLoc + ".tmp")
+        shutil.copytree(bestDir, modelLoc + ".tmp")
+        replaceDir(modelLoc + ".tmp", modelLoc)
+        manifest["folds"].append({
+            "fold": trainerNum + 1,
+            "bestCheckpoint": os.path.basename(trainer.state.best_model_checkpoint or ""),
+            "bestEvalLoss": trainer.state.best_metric,
+            "model": bestDir,
+            "completed": datetime.datetime.now().isoformat(timespec="seconds"),
+        })
+        manifest["finished"] = len(manifest["folds"]) == len(folds)
+        saveManifest(outputDir, manifest)
+        pruneRun(outputDir, manifest)
+        print(f"Trainer {trainerNum+1}/{len(folds)} complete. Best eval_loss: {trainer.state.best_metric}")
+        # At this point, our best model for that dataset split has been saved to bestDir, so load that as the starting model for our next trainer
+        model = bestDir
+
+
+if __name__ == "__main__":
+    runTraining()